@@ -16,11 +16,514 @@ Modes:
 from __future__ import annotations
 
 import argparse
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
 import importlib.util
+import json
+import os
 import re
+import select
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import AbstractContextManager, contextmanager, nullcontext, redirect_stdout
 from dataclasses import dataclass
+from functools import lru_cache, partial
+from itertools import groupby
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional
+from typing import (
+    IO,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+# ----------------------------
+# Instrumentation (--stats / --stats-json)
+# ----------------------------
+
+def _proc_thread_io() -> Optional[Tuple[int, int, int]]:
+    """(rchar, wchar, size of this read) from /proc/thread-self/io, else None."""
+    try:
+        with open("/proc/thread-self/io", "rb") as fileobj:
+            data = fileobj.read()
+    except OSError:
+        return None
+    fields = dict(line.split(b": ", 1) for line in data.splitlines() if b": " in line)
+    return int(fields[b"rchar"]), int(fields[b"wchar"]), len(data)
+
+
+def thread_io_counters() -> Optional[Tuple[int, int]]:
+    """
+    (rchar, wchar) for the calling thread on Linux, else None. The file shows
+    the counters from before it was read; the read itself is added so callers
+    are not billed for it.
+    """
+    sample = _proc_thread_io()
+    if sample is None:
+        return None
+    rchar, wchar, size = sample
+    return rchar + size, wchar
+
+
+class PhaseStats:
+    __slots__ = ("seconds", "count", "bytes_read", "bytes_written")
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.count = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+
+_NOT_MEASURED = nullcontext()
+
+
+class RunStats:
+    """
+    Per-phase busy time, item counts, bytes read/written and skip reasons.
+
+    Phase times are summed over calls, so with worker threads/processes they
+    can exceed wall time. Recording is a no-op until enable() is called.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.phases: Dict[str, PhaseStats] = {}
+        self.skips: Counter = Counter()
+        self.counters: Counter = Counter()
+        self._lock = threading.Lock()
+        self._started = 0.0
+
+    def enable(self) -> None:
+        self.enabled = True
+        self._started = time.perf_counter()
+
+    def add(self, phase: str, seconds: float = 0.0, count: int = 1, bytes_read: int = 0, bytes_written: int = 0) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = PhaseStats()
+            stats.seconds += seconds
+            stats.count += count
+            stats.bytes_read += bytes_read
+            stats.bytes_written += bytes_written
+
+    def measure(self, phase: str, count: int = 1, track_io: bool = True) -> AbstractContextManager:
+        """
+        Times the block into `phase`. With `track_io` the calling thread's
+        read/write byte counters are sampled too (two small /proc reads), so
+        pass False for cheap, CPU-only steps. While disabled this returns a
+        shared no-op context, so per-entry call sites cost next to nothing.
+        """
+        if not self.enabled:
+            return _NOT_MEASURED
+        return self._measure(phase, count, track_io)
+
+    @contextmanager
+    def _measure(self, phase: str, count: int, track_io: bool) -> Iterator[None]:
+        io_before = thread_io_counters() if track_io else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(phase, seconds, count, *_io_since(io_before))
+
+    def skip(self, reason: str) -> None:
+        if self.enabled:
+            with self._lock:
+                self.skips[reason] += 1
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        if self.enabled:
+            with self._lock:
+                self.counters[counter] += amount
+
+    def report(self, **extra: Any) -> Dict[str, Any]:
+        return {
+            "version": 1,
+            **extra,
+            "wall_seconds": round(time.perf_counter() - self._started, 6),
+            "phases": {
+                name: {
+                    "seconds": round(stats.seconds, 6),
+                    "count": stats.count,
+                    "bytes_read": stats.bytes_read,
+                    "bytes_written": stats.bytes_written,
+                }
+                for name, stats in sorted(self.phases.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+            "skips": dict(sorted(self.skips.items())),
+        }
+
+
+STATS = RunStats()
+
+
+def _io_since(before: Optional[Tuple[int, int]]) -> Tuple[int, int]:
+    after = _proc_thread_io() if before is not None else None
+    if before is None or after is None:
+        return 0, 0
+    return after[0] - before[0], after[1] - before[1]
+
+
+def measured_call(fn: Callable[..., R], *args: Any, **kwargs: Any) -> Tuple[R, Tuple[float, int, int]]:
+    """
+    Runs fn and returns (result, (seconds, bytes_read, bytes_written)). For
+    work on pool processes, whose STATS never reach this one: the caller
+    feeds the sample to STATS.add.
+    """
+    io_before = thread_io_counters()
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    return result, (seconds, *_io_since(io_before))
+
+
+def print_stats_summary(report: Dict[str, Any]) -> None:
+    print("\nRun statistics")
+    print("=" * 14)
+    print(f"Wall time: {report['wall_seconds']:.3f}s")
+    if report["phases"]:
+        print(f"\n  {'phase':<22} {'count':>9} {'seconds':>10} {'read':>11} {'written':>11}")
+        for name, phase in report["phases"].items():
+            print(
+                f"  {name:<22} {phase['count']:>9} {phase['seconds']:>10.3f} "
+                f"{_format_bytes(phase['bytes_read']):>11} {_format_bytes(phase['bytes_written']):>11}"
+            )
+    if report["counters"]:
+        print("\n  Counters:")
+        for name, value in report["counters"].items():
+            print(f"    {name:<34} {value}")
+    if report["skips"]:
+        print("\n  Skipped:")
+        for reason, value in report["skips"].items():
+            print(f"    {reason:<34} {value}")
+
+
+def _format_bytes(count: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if count < 1024 or unit == "GiB":
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+    return str(count)
+
+
+# ----------------------------
+# Library walk (shared by rename + metadata)
+# ----------------------------
+
+@dataclass(frozen=True)
+class ScanEntry:
+    path: Path  # relative to root
+    is_dir: bool
+
+
+class Shard(NamedTuple):
+    """
+    Slice `number` (1-based) of `total` of a library, for running one slice
+    per host. Entries directly under root (the artist directories) are
+    assigned by a stable CRC32 of their name, so every host computes the
+    same disjoint split without coordination.
+    """
+
+    number: int
+    total: int
+
+    def owns(self, name: str) -> bool:
+        return zlib.crc32(name.encode("utf-8", "surrogateescape")) % self.total == self.number - 1
+
+    def __str__(self) -> str:
+        return f"{self.number}/{self.total}"
+
+
+# Depth (below root) of the album directories in Artist/Album/track.
+ALBUM_DEPTH = 2
+
+
+class LayoutPrune(NamedTuple):
+    """
+    Restricts a walk to the Artist/Album/track layout derive_metadata_for_file
+    accepts. Hidden directories and directories whose name matches an
+    `ignore` glob are dropped; album-level directories are only listed if
+    their name can be an album (ALBUM_PATTERN or ALBUM_DIR_PATTERN); nothing
+    below album level is listed.
+    """
+
+    ignore: Tuple[str, ...] = ()
+
+    def keeps(self, name: str) -> bool:
+        if name.startswith("."):
+            STATS.skip("walk: hidden directory")
+            return False
+        if any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore):
+            STATS.skip("walk: ignored directory")
+            return False
+        return True
+
+    def descends(self, rel_dir: Path, name: str) -> bool:
+        depth = len(rel_dir.parts) + 1
+        if depth > ALBUM_DEPTH:
+            STATS.skip("walk: below album level")
+            return False
+        if depth == ALBUM_DEPTH and not (ALBUM_PATTERN.match(name) or ALBUM_DIR_PATTERN.match(name)):
+            STATS.skip("walk: not an album directory")
+            return False
+        return True
+
+    def __str__(self) -> str:
+        return " ".join(("prune", *self.ignore))
+
+
+class RunManifest:
+    """
+    Directory mtimes (and subdirectory names) seen by a run. --incremental
+    loads the previous run's manifest so directories whose mtime is unchanged
+    are not listed again; only their known subdirectories are checked.
+    """
+
+    VERSION = 1
+    # Coarse-mtime filesystems (NFS, FAT) can hide a change made in the same
+    # tick as our stat, so very fresh directories are never trusted.
+    RECENT_SLACK_NS = 2_000_000_000
+
+    def __init__(
+        self,
+        root: Path,
+        mode: str,
+        dirs: Optional[Dict[str, Tuple[int, List[str]]]] = None,
+    ) -> None:
+        self.root = root
+        self.mode = mode  # a rename-only run must not hide changes from a metadata-only run
+        self.dirs: Dict[str, Tuple[int, List[str]]] = dirs if dirs is not None else {}
+
+    @classmethod
+    def load(cls, path: Path, root: Path, mode: str) -> "RunManifest":
+        """Reads a saved manifest; a missing, unreadable or foreign one means a full scan."""
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return cls(root, mode)
+        if data.get("version") != cls.VERSION or data.get("root") != str(root) or data.get("mode") != mode:
+            return cls(root, mode)
+        dirs = {key: (mtime_ns, subdirs) for key, (mtime_ns, subdirs) in data["dirs"].items()}
+        return cls(root, mode, dirs)
+
+    def save(self, path: Path) -> None:
+        data = {"version": self.VERSION, "root": str(self.root), "mode": self.mode, "dirs": self.dirs}
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps(data), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def unchanged_subdirs(self, rel_dir: str, mtime_ns: int) -> Optional[List[str]]:
+        known = self.dirs.get(rel_dir)
+        if known is None or known[0] != mtime_ns:
+            return None
+        return known[1]
+
+    def add(self, rel_dir: str, mtime_ns: int, subdirs: List[str]) -> None:
+        if time.time_ns() - mtime_ns < self.RECENT_SLACK_NS:
+            mtime_ns = -1
+        self.dirs[rel_dir] = (mtime_ns, subdirs)
+
+
+class _DirVisit(NamedTuple):
+    rel_dir: Path
+    device: int  # st_dev, 0 unless the directory was stat'ed
+    mtime_ns: int
+    entries: List[ScanEntry]  # empty when the listing was skipped as unchanged
+    subdirs: List[str]  # names to descend into
+
+
+def _visit_directory(
+    root: Path,
+    rel_dir: Path,
+    previous: Optional[RunManifest],
+    track_mtimes: bool,
+    shard: Optional[Shard],
+    prune: Optional[LayoutPrune] = None,
+) -> Optional[_DirVisit]:
+    """
+    One step of iter_library (and async_scan_library): lists rel_dir, or
+    None if it cannot be read. `track_mtimes` stats it first, for the
+    manifest and its st_dev.
+    """
+    device = mtime_ns = 0
+    if track_mtimes:
+        # Stat before listing: a change made while listing then shows up
+        # as a newer mtime on the next run.
+        try:
+            st = os.stat(root / rel_dir)
+        except OSError:
+            return None
+        device, mtime_ns = st.st_dev, st.st_mtime_ns
+
+        known = previous.unchanged_subdirs(rel_dir.as_posix(), mtime_ns) if previous is not None else None
+        if known is not None and shard is not None and rel_dir == Path():
+            known = [name for name in known if shard.owns(name)]
+        if known is not None:
+            STATS.count("directories unchanged (not listed)")
+            return _DirVisit(rel_dir, device, mtime_ns, [], known)
+
+    try:
+        with STATS.measure("walk"), os.scandir(root / rel_dir) as it:
+            listing = list(it)
+    except PermissionError:
+        STATS.skip("walk: permission denied")
+        return None
+
+    STATS.count("entries listed", len(listing))
+    if shard is not None and rel_dir == Path():
+        listing = [entry for entry in listing if shard.owns(entry.name)]
+    entries: List[ScanEntry] = []
+    subdirs: List[str] = []
+    for entry in listing:
+        rel_path = rel_dir / entry.name
+        if entry.is_dir():
+            if prune is not None and not prune.keeps(entry.name):
+                continue
+            entries.append(ScanEntry(path=rel_path, is_dir=True))
+            if not entry.is_symlink() and (prune is None or prune.descends(rel_dir, entry.name)):
+                subdirs.append(entry.name)
+        elif entry.is_file():
+            entries.append(ScanEntry(path=rel_path, is_dir=False))
+    return _DirVisit(rel_dir, device, mtime_ns, entries, subdirs)
+
+
+def _walk_serial(visit: Callable[[Path], Optional[_DirVisit]], start: Path) -> Iterator[_DirVisit]:
+    stack = [start]
+    while stack:
+        result = visit(stack.pop())
+        if result is None:
+            continue
+        stack.extend(result.rel_dir / name for name in result.subdirs)
+        yield result
+
+
+def _walk_parallel(visit: Callable[[Path], Optional[_DirVisit]], start: Path, jobs: int) -> Iterator[_DirVisit]:
+    """
+    Runs `visit` on `jobs` threads. Every listed subdirectory goes straight
+    back on the pool's shared queue, so up to `jobs` listings are in flight
+    whenever that many directories are known; visits come back as they finish.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = {pool.submit(visit, start)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result is None:
+                    continue
+                pending.update(pool.submit(visit, result.rel_dir / name) for name in result.subdirs)
+                yield result
+
+
+def iter_library(
+    root: Path,
+    previous: Optional[RunManifest] = None,
+    record: Optional[RunManifest] = None,
+    start: Path = Path(),
+    shard: Optional[Shard] = None,
+    walk_jobs: int = 1,
+    prune: Optional[LayoutPrune] = None,
+) -> Iterator[ScanEntry]:
+    """
+    Walks root once with os.scandir and yields every directory and file below
+    it (or below the root-relative `start` directory). Paths are relative to root.
+
+    Type checks use the cached DirEntry info, so on most filesystems no extra
+    stat is issued per entry. Like Path.rglob, symlinked directories are
+    reported but not descended into, and unreadable directories are skipped.
+
+    With `previous`, directories whose mtime matches that manifest are not
+    listed (their entries are not yielded) but their subdirectories are still
+    visited. Every visited directory is added to `record`.
+
+    With `shard`, only the entries directly under root that it owns are
+    yielded and descended into. With `prune`, see LayoutPrune.
+
+    `walk_jobs` > 1 lists directories on that many threads (for NFS/SMB,
+    where each listing is a server round trip). Each directory's entries
+    still come out together, but directories are yielded in the order their
+    listings finish.
+    """
+    track_mtimes = previous is not None or record is not None
+    visit = partial(_visit_directory, root, previous=previous, track_mtimes=track_mtimes, shard=shard, prune=prune)
+    if walk_jobs > 1:
+        visits = _walk_parallel(visit, start, walk_jobs)
+    else:
+        visits = _walk_serial(visit, start)
+
+    for result in visits:
+        yield from result.entries
+        if record is not None:
+            record.add(result.rel_dir.as_posix(), result.mtime_ns, result.subdirs)
+
+
+def scan_library(
+    root: Path,
+    previous: Optional[RunManifest] = None,
+    record: Optional[RunManifest] = None,
+    shard: Optional[Shard] = None,
+    walk_jobs: int = 1,
+    prune: Optional[LayoutPrune] = None,
+) -> List[ScanEntry]:
+    return list(iter_library(root, previous, record, shard=shard, walk_jobs=walk_jobs, prune=prune))
+
+
+def ordered_map(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    jobs: int,
+    executor_cls: Type[Executor] = ThreadPoolExecutor,
+) -> Iterator[R]:
+    """
+    Like map(), but runs `fn` on up to `jobs` workers (threads by default).
+
+    At most 2 * jobs items are in flight at once, so memory stays flat no
+    matter how long `items` is, and results come back in input order.
+    """
+    if jobs <= 1:
+        yield from map(fn, items)
+        return
+
+    with executor_cls(max_workers=jobs) as pool:
+        pending: Deque = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 # ----------------------------
@@ -31,11 +534,43 @@ ALBUM_DIR_PATTERN = re.compile(r"^(?P<year>\d{4})\s*-\s*(?P<album>.+)$")
 TRACK_FILE_PATTERN = re.compile(r"^(?P<num>\d{1,3})\s*-\s*(?P<title>.+)$")
 
 
-@dataclass(frozen=True)
+@lru_cache(maxsize=4096)
+def intern_dir(path: Path) -> Path:
+    """
+    Returns the first equal Path seen recently, so actions in the same
+    directory share one parent object (plans are grouped by directory).
+    """
+    return path
+
+
 class RenameAction:
-    kind: str  # "dir" or "file"
-    source: Path
-    target: Path
+    """
+    One planned rename. A rename only changes the last path component, so
+    it is stored as a shared parent directory (intern_dir) plus the two
+    interned names; `source`/`target` are rebuilt on access.
+    """
+
+    __slots__ = ("parent", "source_name", "target_name", "is_dir")
+
+    def __init__(self, kind: str, source: Path, target: Path) -> None:
+        if source.parent != target.parent:
+            raise ValueError(f"rename must stay in its directory: {source} -> {target}")
+        self.parent = intern_dir(source.parent)
+        self.source_name = sys.intern(source.name)
+        self.target_name = sys.intern(target.name)
+        self.is_dir = kind == "dir"
+
+    @property
+    def kind(self) -> str:
+        return "dir" if self.is_dir else "file"
+
+    @property
+    def source(self) -> Path:
+        return self.parent / self.source_name
+
+    @property
+    def target(self) -> Path:
+        return self.parent / self.target_name
 
     @property
     def relative_source(self) -> str:
@@ -45,6 +580,18 @@ class RenameAction:
     def relative_target(self) -> str:
         return str(self.target)
 
+    def _key(self) -> Tuple[Path, str, str, bool]:
+        return (self.parent, self.source_name, self.target_name, self.is_dir)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, RenameAction) and self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def __repr__(self) -> str:
+        return f"RenameAction(kind={self.kind!r}, source={self.source!r}, target={self.target!r})"
+
 
 def normalized_album_name(name: str, album_format: str) -> Optional[str]:
     """
@@ -81,48 +628,98 @@ def normalized_track_name(stem: str, track_format: str) -> Optional[str]:
     return normalized if normalized != stem else None
 
 
-def gather_rename_actions(root: Path, album_format: str, track_format: str) -> List[RenameAction]:
-    actions: List[RenameAction] = []
+def iter_rename_actions(
+    root: Path,
+    album_format: str,
+    track_format: str,
+    entries: Optional[Iterable[ScanEntry]] = None,
+    walk_jobs: int = 1,
+) -> Iterator[RenameAction]:
+    """
+    Plans renames from a single library walk. Pass `entries` to reuse a walk
+    that was already done (e.g. shared with the metadata phase); otherwise
+    the tree is walked on `walk_jobs` threads.
 
-    # Files first
-    for path in root.rglob("*"):
-        if not path.is_file():
-            continue
+    File renames stream out as the walk finds them, grouped by directory.
+    Directory renames are held back and yielded last, deepest-first, since
+    they must be applied after the files inside them.
+    """
+    if entries is None:
+        entries = iter_library(root, walk_jobs=walk_jobs)
 
-        normalized_stem = normalized_track_name(path.stem, track_format)
-        if normalized_stem is None:
-            continue
+    dir_actions: List[RenameAction] = []
 
-        target = path.with_name(f"{normalized_stem}{path.suffix}")
-        if target != path:
-            actions.append(
-                RenameAction(
-                    kind="file",
-                    source=path.relative_to(root),
-                    target=target.relative_to(root),
-                )
-            )
+    for entry in entries:
+        path = entry.path
+        if entry.is_dir:
+            with STATS.measure("plan renames", track_io=False):
+                normalized_dir = normalized_album_name(path.name, album_format)
+            if normalized_dir is None:
+                STATS.skip("rename: folder name not an album")
+                continue
 
-    # Dirs second
-    for path in root.rglob("*"):
-        if not path.is_dir():
-            continue
+            target = path.with_name(normalized_dir)
+            if target != path:
+                dir_actions.append(RenameAction(kind="dir", source=path, target=target))
+            else:
+                STATS.skip("rename: folder already normalized")
+        else:
+            with STATS.measure("plan renames", track_io=False):
+                normalized_stem = normalized_track_name(path.stem, track_format)
+            if normalized_stem is None:
+                STATS.skip("rename: file name not a track")
+                continue
 
-        normalized_dir = normalized_album_name(path.name, album_format)
-        if normalized_dir is None:
-            continue
+            target = path.with_name(f"{normalized_stem}{path.suffix}")
+            if target != path:
+                yield RenameAction(kind="file", source=path, target=target)
+            else:
+                STATS.skip("rename: file already normalized")
 
-        target = path.with_name(normalized_dir)
-        if target != path:
-            actions.append(
-                RenameAction(
-                    kind="dir",
-                    source=path.relative_to(root),
-                    target=target.relative_to(root),
-                )
-            )
+    # Files first, dirs second
+    dir_actions.sort(key=lambda a: (-len(a.parent.parts), a.relative_source))
+    yield from dir_actions
+
+
+def gather_rename_actions(
+    root: Path,
+    album_format: str,
+    track_format: str,
+    entries: Optional[Iterable[ScanEntry]] = None,
+    walk_jobs: int = 1,
+) -> List[RenameAction]:
+    return list(iter_rename_actions(root, album_format, track_format, entries=entries, walk_jobs=walk_jobs))
 
-    return actions
+
+def predict_renamed_paths(paths: Iterable[Path], applied: Iterable[RenameAction]) -> List[Path]:
+    """
+    Maps pre-rename relative paths to where they live after `applied` ran.
+
+    Only the final path component changes in a rename, so each ancestor is
+    looked up by its original path and swapped for its new name.
+    """
+    file_targets: Dict[Path, Path] = {}
+    dir_names: Dict[Path, str] = {}
+    for action in applied:
+        if action.kind == "file":
+            file_targets[action.source] = action.target
+        else:
+            dir_names[action.source] = action.target.name
+
+    predicted: List[Path] = []
+    for path in paths:
+        new_path = file_targets.get(path, path)
+        if dir_names:
+            parts = list(new_path.parts)
+            prefix = Path()
+            for idx, part in enumerate(path.parts[:-1]):
+                prefix = prefix / part
+                new_name = dir_names.get(prefix)
+                if new_name is not None:
+                    parts[idx] = new_name
+            new_path = Path(*parts)
+        predicted.append(new_path)
+    return predicted
 
 
 def print_rename_preview(actions: Iterable[RenameAction]) -> None:
@@ -150,45 +747,165 @@ def print_rename_preview(actions: Iterable[RenameAction]) -> None:
     print(f"\nTotal: {len(actions)} rename(s)")
 
 
-def apply_rename_actions(root: Path, actions: Iterable[RenameAction]) -> int:
+def apply_rename_actions(
+    root: Path,
+    actions: Iterable[RenameAction],
+    completed: Optional[List[RenameAction]] = None,
+    journal: Optional[ApplyJournal] = None,
+) -> int:
     """
     Applies renames.
     - Files are renamed first.
     - Directories are renamed after, deepest-first to avoid path conflicts.
+    - Each directory is handled in one batch (rename_in_directory).
+    - Successfully applied actions are appended to `completed` when given.
+    - With a `journal`, renames it already records are skipped and new ones
+      are recorded.
     """
-    actions = list(actions)
+    if journal is not None:
+        actions = journal.pending_renames(actions)
     applied = 0
+    for level in schedule_renames(actions):
+        for batch in level:
+            if journal is not None:
+                journal.renaming(batch)
+            for action, skipped in zip(batch, rename_in_directory(root, batch[0].parent, batch)):
+                if report_rename(action, skipped):
+                    applied += 1
+                    if completed is not None:
+                        completed.append(action)
+                    if journal is not None:
+                        journal.renamed(action)
+                elif journal is not None:
+                    journal.skipped(action)
+
+    return applied
 
-    files = sorted((a for a in actions if a.kind == "file"), key=lambda a: a.relative_source)
+
+def schedule_renames(actions: Iterable[RenameAction]) -> List[List[List[RenameAction]]]:
+    """
+    Orders renames into levels of per-directory batches: every file rename
+    first, then directory renames one depth at a time, deepest first. The
+    batches of a level are in different directories and independent of
+    each other; a level must finish before the next one starts.
+    """
+    actions = list(actions)
+    files = sorted((a for a in actions if not a.is_dir), key=lambda a: (a.parent.parts, a.source_name))
     dirs = sorted(
-        (a for a in actions if a.kind == "dir"),
-        key=lambda a: len(Path(a.relative_source).parts),
-        reverse=True,
+        (a for a in actions if a.is_dir),
+        key=lambda a: (-len(a.parent.parts), a.parent.parts, a.source_name),
     )
+    levels = [files, *(list(level) for _, level in groupby(dirs, key=lambda a: len(a.parent.parts)))]
+    return [[list(batch) for _, batch in groupby(level, key=lambda a: a.parent)] for level in levels if level]
 
-    for action in [*files, *dirs]:
-        src = root / action.source
-        dst = root / action.target
 
-        if not src.exists():
-            print(f"[SKIP] source missing: {action.relative_source}")
-            continue
+# Rename relative to an open directory, so each rename resolves one name
+# instead of the whole path (not available on Windows).
+RENAME_WITH_DIR_FD = os.rename in os.supports_dir_fd and os.listdir in os.supports_fd
 
-        if dst.exists():
-            print(f"[SKIP] target already exists: {action.relative_target}")
-            continue
 
-        src.rename(dst)
-        applied += 1
-        print(f"[OK] {action.relative_source} -> {action.relative_target}")
+def rename_in_directory(root: Path, parent: Path, actions: List[RenameAction]) -> List[Optional[str]]:
+    """
+    Applies renames whose sources and targets are all in `parent` (a rename
+    only changes the last path component). The directory is listed once and
+    sources/targets are checked against that listing, replacing two stat
+    calls per action. Returns the skip reason for each action, or None if
+    it was renamed.
+    """
+    dir_path = root / parent
+    try:
+        fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY) if RENAME_WITH_DIR_FD else None
+    except OSError:
+        return ["source missing"] * len(actions)
 
-    return applied
+    try:
+        try:
+            with STATS.measure("rename: list directory", track_io=False):
+                names = set(os.listdir(fd if fd is not None else dir_path))
+        except OSError:
+            return ["source missing"] * len(actions)
+        # On case-insensitive filesystems "Foo" exists if "foo" does; such
+        # near-collisions are checked on disk like before.
+        folded = Counter(name.casefold() for name in names)
+
+        results: List[Optional[str]] = []
+        for action in actions:
+            src_name = action.source_name
+            dst_name = action.target_name
+            if src_name not in names:
+                results.append("source missing")
+                continue
+            if dst_name in names or (
+                folded[dst_name.casefold()] > (src_name.casefold() == dst_name.casefold())
+                and os.path.lexists(dir_path / dst_name)
+            ):
+                results.append("target exists")
+                continue
+
+            with STATS.measure("rename", track_io=False):
+                if fd is not None:
+                    os.rename(src_name, dst_name, src_dir_fd=fd, dst_dir_fd=fd)
+                else:
+                    os.rename(dir_path / src_name, dir_path / dst_name)
+            names.discard(src_name)
+            names.add(dst_name)
+            folded[src_name.casefold()] -= 1
+            folded[dst_name.casefold()] += 1
+            results.append(None)
+        return results
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def report_rename(action: RenameAction, skipped: Optional[str]) -> bool:
+    """Prints the outcome of one rename; True if it was applied."""
+    if skipped == "source missing":
+        print(f"[SKIP] source missing: {action.relative_source}")
+    elif skipped is not None:
+        print(f"[SKIP] target already exists: {action.relative_target}")
+    else:
+        print(f"[OK] {action.relative_source} -> {action.relative_target}")
+        return True
+    STATS.skip(f"rename: {skipped}")
+    return False
 
 
-def run_filenames(root: Path, album_format: str, track_format: str, yes: bool) -> int:
-    actions = gather_rename_actions(root, album_format, track_format)
+def run_filenames(
+    root: Path,
+    album_format: str,
+    track_format: str,
+    yes: bool,
+    entries: Optional[Iterable[ScanEntry]] = None,
+    completed: Optional[List[RenameAction]] = None,
+    stream: bool = False,
+    plan_in: Optional[Path] = None,
+    plan_out: Optional[Path] = None,
+    journal: Optional[ApplyJournal] = None,
+) -> int:
+    """
+    With `plan_out` the planned renames are written to that plan file
+    instead of being applied; with `plan_in` they are read from one (no
+    walk) and each is applied only if its source is unchanged since planning.
+    Applied renames are recorded in `journal`.
+    """
+    signatures: Optional[Dict[Path, StatSignature]] = None
+    if plan_in is not None:
+        try:
+            actions, signatures = read_plan(plan_in, "rename", root)
+        except (OSError, ValueError, ImportError) as exc:
+            print(f"Error: cannot read plan {plan_in}: {exc}")
+            return 1
+    elif stream and plan_out is None:
+        actions_iter = iter_rename_actions(root, album_format, track_format, entries=entries)
+        return _run_filenames_streaming(root, actions_iter, yes, completed, journal)
+    else:
+        actions = gather_rename_actions(root, album_format, track_format, entries=entries)
     print_rename_preview(actions)
 
+    if plan_out is not None:
+        return write_plan_or_report(plan_out, "rename", root, actions)
+
     if not actions:
         return 0
 
@@ -199,7 +916,67 @@ def run_filenames(root: Path, album_format: str, track_format: str, yes: bool) -
             return 0
 
     print("\nApplying changes...")
-    applied = apply_rename_actions(root, actions)
+    if signatures is not None:
+        # Renames the journal already records have moved their source, so
+        # they are settled here rather than reported as changed.
+        if journal is not None:
+            actions = journal.pending_renames(actions)
+        actions = unchanged_since_plan(root, actions, signatures)
+    applied = apply_rename_actions(root, actions, completed=completed, journal=journal)
+    print(f"\nDone. Applied {applied} rename(s).")
+    return 0
+
+
+def _run_filenames_streaming(
+    root: Path,
+    actions: Iterable[RenameAction],
+    yes: bool,
+    completed: Optional[List[RenameAction]],
+    journal: Optional[ApplyJournal] = None,
+) -> int:
+    """
+    Prints the preview one directory at a time as the walk progresses. With
+    `yes`, each directory's renames are applied right after they are shown;
+    otherwise the plan is kept for the usual confirmation at the end.
+    """
+    planned: List[RenameAction] = []
+    total = 0
+    applied = 0
+    section = ""
+
+    for _, group_iter in groupby(actions, key=lambda a: (a.is_dir, a.parent)):
+        group = sorted(group_iter, key=lambda a: a.relative_source)
+        if total == 0:
+            print("Preview of planned renames")
+            print("=" * 26)
+        if group[0].kind != section:
+            section = group[0].kind
+            print("\nFiles:" if section == "file" else "\nFolders:")
+
+        for action in group:
+            print(f"  {action.relative_source} -> {action.relative_target}")
+        total += len(group)
+
+        if yes:
+            applied += apply_rename_actions(root, group, completed=completed, journal=journal)
+        else:
+            planned.extend(group)
+
+    if total == 0:
+        print("No matching folders/files found. Nothing to rename.")
+        return 0
+
+    print(f"\nTotal: {total} rename(s)")
+
+    if not yes:
+        answer = input("\nApply these changes? [y/N]: ").strip().lower()
+        if answer not in {"y", "yes"}:
+            print("Aborted. No changes applied.")
+            return 0
+
+        print("\nApplying changes...")
+        applied = apply_rename_actions(root, planned, completed=completed, journal=journal)
+
     print(f"\nDone. Applied {applied} rename(s).")
     return 0
 
@@ -228,15 +1005,83 @@ ALBUM_PATTERN = re.compile(r"^(?P<album>.+?)\s*\((?P<year>\d{4})\)$")
 TRACK_PATTERN = re.compile(r"^(?P<track>\d{2})\b")
 
 
-@dataclass(frozen=True)
+# Every key derive_metadata_for_file can produce. Actions store tags as a
+# bitmask over these plus a tuple of the present values, in this order.
+TAG_KEYS = ("album", "date", "year", "tracknumber", "artist", "albumartist", "author")
+
+
+def pack_tags(tags: Dict[str, str]) -> Tuple[int, Tuple[str, ...]]:
+    """
+    {key: value} -> (mask, values). Values are interned, so the album,
+    artist and year strings repeated on every track of an album are stored once.
+    """
+    mask = 0
+    values: List[str] = []
+    for index, key in enumerate(TAG_KEYS):
+        value = tags.get(key)
+        if value is not None:
+            mask |= 1 << index
+            values.append(sys.intern(value))
+    if len(values) != len(tags):
+        raise ValueError(f"unknown tag keys: {sorted(set(tags) - set(TAG_KEYS))}")
+    return mask, tuple(values)
+
+
+@lru_cache(maxsize=None)
+def _mask_keys(mask: int) -> Tuple[str, ...]:
+    return tuple(key for index, key in enumerate(TAG_KEYS) if mask & (1 << index))
+
+
+def unpack_tags(mask: int, values: Tuple[str, ...]) -> Dict[str, str]:
+    return dict(zip(_mask_keys(mask), values))
+
+
 class MetadataAction:
-    file_path: Path
-    updates: Dict[str, str]
-    current: Dict[str, str]
+    """
+    One planned tag update. `updates`/`current` are kept packed (pack_tags)
+    and the path as a shared parent directory plus an interned file name;
+    the dicts and the Path are rebuilt on access.
+    """
+
+    __slots__ = ("parent", "name", "update_mask", "update_values", "current_mask", "current_values")
+
+    def __init__(self, file_path: Path, updates: Dict[str, str], current: Dict[str, str]) -> None:
+        self.parent = intern_dir(file_path.parent)
+        self.name = sys.intern(file_path.name)
+        self.update_mask, self.update_values = pack_tags(updates)
+        self.current_mask, self.current_values = pack_tags(current)
+
+    @property
+    def file_path(self) -> Path:
+        return self.parent / self.name
+
+    @property
+    def updates(self) -> Dict[str, str]:
+        return unpack_tags(self.update_mask, self.update_values)
+
+    @property
+    def current(self) -> Dict[str, str]:
+        return unpack_tags(self.current_mask, self.current_values)
+
+    def _key(self) -> Tuple[Path, str, int, Tuple[str, ...], int, Tuple[str, ...]]:
+        return (self.parent, self.name, self.update_mask, self.update_values, self.current_mask, self.current_values)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, MetadataAction) and self._key() == other._key()
+
+    def __hash__(self) -> int:
+        return hash(self._key())
+
+    def __repr__(self) -> str:
+        return f"MetadataAction(file_path={self.file_path!r}, updates={self.updates!r}, current={self.current!r})"
+
+
+def has_audio_extension(path: Path) -> bool:
+    return path.suffix.lower() in AUDIO_EXTENSIONS
 
 
 def is_audio_file(path: Path) -> bool:
-    return path.is_file() and path.suffix.lower() in AUDIO_EXTENSIONS
+    return path.is_file() and has_audio_extension(path)
 
 
 def derive_metadata_for_file(path: Path) -> Optional[Dict[str, str]]:
@@ -247,21 +1092,30 @@ def derive_metadata_for_file(path: Path) -> Optional[Dict[str, str]]:
     Example:
       Daft Punk/Discovery (2001)/01 One More Time.flac
     """
-    album_dir = path.parent
-    author_dir = album_dir.parent
-
-    album_match = ALBUM_PATTERN.match(album_dir.name)
-    if not album_match:
+    album_tags = derive_album_metadata(path.parent)
+    if album_tags is None:
         return None
+    return derive_track_metadata(album_tags, path.stem)
 
-    track_match = TRACK_PATTERN.match(path.stem)
-    if not track_match:
+
+def derive_album_metadata(album_dir: Path) -> Optional[Dict[str, str]]:
+    """
+    The tags shared by every track in an Artist/Album (YYYY) directory, or
+    None if it does not match. Memoized; the returned dict is shared and
+    must not be modified.
+    """
+    return _album_metadata(album_dir.parent.name, album_dir.name)
+
+
+@lru_cache(maxsize=4096)
+def _album_metadata(author_name: str, album_name: str) -> Optional[Dict[str, str]]:
+    album_match = ALBUM_PATTERN.match(album_name)
+    if not album_match:
         return None
 
     album = album_match.group("album").strip()
     year = album_match.group("year")
-    track = track_match.group("track")
-    author = author_dir.name.strip()
+    author = author_name.strip()
 
     if not album or not author:
         return None
@@ -270,137 +1124,2488 @@ def derive_metadata_for_file(path: Path) -> Optional[Dict[str, str]]:
         "album": album,
         "date": year,
         "year": year,
-        "tracknumber": track,
         "artist": author,
         "albumartist": author,
         "author": author,
     }
 
 
-def mutagen_file(path: Path):
-    from mutagen import File as _MutagenFile  # type: ignore
+def derive_track_metadata(album_tags: Dict[str, str], stem: str) -> Optional[Dict[str, str]]:
+    """Album tags plus the track number from a "NN Track Title" file stem."""
+    track_match = TRACK_PATTERN.match(stem)
+    if not track_match:
+        return None
+    return {**album_tags, "tracknumber": track_match.group("track")}
 
-    return _MutagenFile(path, easy=True)
 
+# Native tag fields for the keys derive_metadata_for_file produces. The tags
+# are read and written through these directly instead of through mutagen's
+# EasyID3/EasyMP4 translation tables. Keys without an entry ("year" for
+# both, "author" for MP4) have no field and are left out.
+ID3_FRAMES = {
+    "album": "TALB",
+    "artist": "TPE1",
+    "albumartist": "TPE2",
+    "tracknumber": "TRCK",
+    "date": "TDRC",
+    "author": "TOLY",
+}
+MP4_ATOMS = {
+    "album": "\xa9alb",
+    "artist": "\xa9ART",
+    "albumartist": "aART",
+    "tracknumber": "trkn",
+    "date": "\xa9day",
+}
 
-def read_current_tags(path: Path, desired_keys: Iterable[str]) -> Dict[str, str]:
-    audio = mutagen_file(path)
-    if audio is None:
-        return {}
+def mp4_track_text(track: int, total: int) -> str:
+    """
+    An MP4 trkn pair as text. trkn stores integers, so the number is
+    zero-padded like the NN taken from file names (TRACK_PATTERN); otherwise
+    "03" would be written, read back as "3" and written again every run.
+    """
+    return f"{track:02d}/{total}" if total else f"{track:02d}"
 
-    current: Dict[str, str] = {}
-    for key in desired_keys:
-        value = audio.get(key)
-        if isinstance(value, list):
-            current[key] = value[0] if value else ""
-        elif isinstance(value, str):
-            current[key] = value
-    return current
 
+# Files whose tags are ID3 (native mutagen types, see MUTAGEN_TYPES) or MP4 items.
+ID3_SUFFIXES = {".mp3", ".aiff", ".wav"}
+MP4_SUFFIXES = {".m4a", ".mp4"}
 
-def gather_metadata_actions(root: Path) -> List[MetadataAction]:
-    actions: List[MetadataAction] = []
 
-    for path in root.rglob("*"):
-        if not is_audio_file(path):
-            continue
+def drop_unsupported_keys(path: Path, updates: Dict[str, str]) -> Dict[str, str]:
+    """
+    ID3 and MP4 have no field for some keys, such as "year"; leave those out
+    rather than failing the save. Vorbis comments and APEv2 accept any key.
+    """
+    suffix = path.suffix.lower()
+    if suffix in ID3_SUFFIXES:
+        return {k: v for k, v in updates.items() if k in ID3_FRAMES}
+    if suffix in MP4_SUFFIXES:
+        return {k: v for k, v in updates.items() if k in MP4_ATOMS}
+    return updates
 
-        updates = derive_metadata_for_file(path)
-        if updates is None:
-            continue
 
-        current = read_current_tags(path, updates.keys())
-        effective_updates = {k: v for k, v in updates.items() if current.get(k, "") != v}
-        if not effective_updates:
-            continue
+# Suffix -> the native mutagen class for a well-formed file with that
+# extension (what mutagen.File would pick). Opening it directly skips File's
+# step of reading the header and scoring every registered format.
+MUTAGEN_TYPES: Dict[str, Tuple[str, str]] = {
+    ".aac": ("mutagen.aac", "AAC"),
+    ".aiff": ("mutagen.aiff", "AIFF"),
+    ".ape": ("mutagen.monkeysaudio", "MonkeysAudio"),
+    ".flac": ("mutagen.flac", "FLAC"),
+    ".m4a": ("mutagen.mp4", "MP4"),
+    ".mp3": ("mutagen.mp3", "MP3"),
+    ".mp4": ("mutagen.mp4", "MP4"),
+    ".oga": ("mutagen.oggvorbis", "OggVorbis"),
+    ".ogg": ("mutagen.oggvorbis", "OggVorbis"),
+    ".opus": ("mutagen.oggopus", "OggOpus"),
+    ".wav": ("mutagen.wave", "WAVE"),
+    ".wma": ("mutagen.asf", "ASF"),
+}
 
-        actions.append(
-            MetadataAction(
-                file_path=path.relative_to(root),
-                updates=effective_updates,
-                current=current,
-            )
+
+@lru_cache(maxsize=None)
+def _mutagen_type(suffix: str) -> Optional[Any]:
+    spec = MUTAGEN_TYPES.get(suffix)
+    if spec is None:
+        return None
+    module_name, class_name = spec
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def mutagen_file(path: Path):
+    """
+    mutagen.File(path), but files are first opened with the class their
+    extension implies (MUTAGEN_TYPES). Only if that class rejects the file
+    (e.g. FLAC-in-Ogg named .oga) does mutagen probe all formats. Returns
+    native objects; use tags_from_audio / set_tags for the derived keys.
+    """
+    from mutagen import File as _MutagenFile, MutagenError  # type: ignore
+
+    kind = _mutagen_type(path.suffix.lower())
+    if kind is not None:
+        try:
+            return kind(path)
+        except MutagenError:
+            STATS.count("format dispatch fallbacks to probe")
+    return _MutagenFile(path)
+
+
+def _tag_values(audio: Any, key: str) -> Any:
+    """The values stored for `key`, read from the native field where there is one."""
+    from mutagen.id3 import ID3  # type: ignore
+    from mutagen.mp4 import MP4Tags  # type: ignore
+
+    tags = audio if isinstance(audio, ID3) else getattr(audio, "tags", None)
+    if isinstance(tags, ID3):
+        frame = tags.get(ID3_FRAMES.get(key, ""))
+        return [str(text) for text in frame.text] if frame is not None else None
+    if isinstance(tags, MP4Tags):
+        values = tags.get(MP4_ATOMS.get(key, ""))
+        if values is not None and key == "tracknumber":
+            return [mp4_track_text(track, total) for track, total in values]
+        return values
+    return audio.get(key)
+
+
+def set_tags(audio: Any, updates: Dict[str, str]) -> None:
+    """
+    Writes `updates` in one pass: ID3 frames and MP4 atoms are built
+    directly (as EasyID3/EasyMP4 would build them); other formats take the
+    keys as field names.
+    """
+    from mutagen.id3 import ID3, Frames  # type: ignore
+    from mutagen.mp4 import MP4Tags  # type: ignore
+
+    if getattr(audio, "tags", None) is None and hasattr(audio, "add_tags"):
+        audio.add_tags()
+    tags = getattr(audio, "tags", None)
+    if isinstance(tags, ID3):
+        for key, value in updates.items():
+            frame_id = ID3_FRAMES[key]
+            tags.add(Frames[frame_id](encoding=3, text=[value]))
+    elif isinstance(tags, MP4Tags):
+        for key, value in updates.items():
+            if key == "tracknumber":
+                track, _, total = value.partition("/")
+                tags["trkn"] = [(int(track), int(total or 0))]
+            else:
+                tags[MP4_ATOMS[key]] = [value]
+    else:
+        for key, value in updates.items():
+            audio[key] = [value]
+
+
+def read_current_tags(path: Path, desired_keys: Iterable[str]) -> Dict[str, str]:
+    return tags_from_audio(mutagen_file(path), desired_keys)
+
+
+def tags_from_audio(audio: Any, desired_keys: Iterable[str]) -> Dict[str, str]:
+    if audio is None:
+        return {}
+
+    current: Dict[str, str] = {}
+    for key in desired_keys:
+        value = _tag_values(audio, key)
+        if isinstance(value, list):
+            current[key] = value[0] if value else ""
+        elif isinstance(value, str):
+            current[key] = value
+    return current
+
+
+# ----------------------------
+# Header-only tag reader
+# ----------------------------
+
+# Tag bytes read per file before giving up and deferring to mutagen.
+TAG_READ_LIMIT = 1 << 20
+
+MP4_TEXT_ITEMS = {
+    b"\xa9alb": "album",
+    b"\xa9ART": "artist",
+    b"aART": "albumartist",
+    b"\xa9day": "date",
+}
+
+
+def read_tags_header_only(path: Path, desired_keys: Iterable[str]) -> Optional[Dict[str, str]]:
+    """
+    Reads only the tag block (FLAC METADATA_BLOCKs, Ogg comment packet, MP4
+    moov/udta/meta/ilst, ID3) and returns what read_current_tags would.
+
+    Stream info is never built, so no audio frames are scanned. Returns None
+    whenever the file is not clearly one of those layouts or looks unusual;
+    the caller then falls back to mutagen.
+    """
+    suffix = path.suffix.lower()
+    try:
+        with path.open("rb") as fileobj:
+            magic = fileobj.read(12)
+            fileobj.seek(0)
+            if suffix == ".flac" and magic.startswith(b"fLaC"):
+                fields = _flac_comment_fields(fileobj)
+            elif suffix in {".ogg", ".oga", ".opus"} and magic.startswith(b"OggS"):
+                fields = _ogg_comment_fields(fileobj)
+            elif suffix in {".m4a", ".mp4"} and magic[4:8] == b"ftyp":
+                fields = _mp4_item_fields(fileobj)
+            elif suffix == ".mp3" and (magic.startswith(b"ID3") or magic[:2] >= b"\xff\xe0"):
+                fields = _id3_fields(fileobj)
+            else:
+                return None
+    except (ValueError, struct.error):
+        return None
+
+    if fields is None:
+        return None
+    return tags_from_audio(fields, desired_keys)
+
+
+def _vorbis_comment_fields(data: bytes) -> Optional[Dict[str, List[str]]]:
+    """Vorbis comment block -> {lowercased key: [values]}, like mutagen's VComment lookups."""
+    vendor_length = struct.unpack_from("<I", data, 0)[0]
+    pos = 4 + vendor_length
+    count = struct.unpack_from("<I", data, pos)[0]
+    pos += 4
+
+    fields: Dict[str, List[str]] = {}
+    for _ in range(count):
+        length = struct.unpack_from("<I", data, pos)[0]
+        pos += 4
+        entry = data[pos:pos + length]
+        pos += length
+        key, sep, value = entry.partition(b"=")
+        if len(entry) != length or not sep:
+            return None
+        if not key or any(c < 0x20 or c > 0x7D or c == 0x3D for c in key):
+            return None
+        fields.setdefault(key.decode("ascii").lower(), []).append(value.decode("utf-8", "replace"))
+    return fields
+
+
+def _flac_comment_fields(fileobj: IO[bytes]) -> Optional[Dict[str, List[str]]]:
+    fileobj.seek(4)
+    fields: Optional[Dict[str, List[str]]] = None
+    first = True
+    while True:
+        header = fileobj.read(4)
+        if len(header) != 4:
+            return None
+        block_type = header[0] & 0x7F
+        size = int.from_bytes(header[1:], "big")
+        if first and block_type != 0:
+            return None
+        first = False
+
+        if block_type == 4:
+            if fields is not None or size > TAG_READ_LIMIT:
+                return None
+            data = fileobj.read(size)
+            if len(data) != size:
+                return None
+            fields = _vorbis_comment_fields(data)
+            if fields is None:
+                return None
+        elif block_type == 127:
+            return None
+        else:
+            fileobj.seek(size, os.SEEK_CUR)
+
+        if header[0] & 0x80:
+            return fields if fields is not None else {}
+
+
+def _ogg_packets(fileobj: IO[bytes], count: int) -> Optional[List[bytes]]:
+    """First `count` packets of a single (non-multiplexed) Ogg logical stream."""
+    packets: List[bytes] = []
+    current = b""
+    serial = None
+    budget = TAG_READ_LIMIT
+    while len(packets) < count:
+        header = fileobj.read(27)
+        if len(header) != 27 or header[:4] != b"OggS" or header[4] != 0:
+            return None
+        if serial is None:
+            serial = header[14:18]
+        elif header[14:18] != serial:
+            return None
+
+        lacing = fileobj.read(header[26])
+        body = fileobj.read(sum(lacing))
+        budget -= len(body)
+        if len(lacing) != header[26] or len(body) != sum(lacing) or budget < 0:
+            return None
+
+        offset = 0
+        for lace in lacing:
+            current += body[offset:offset + lace]
+            offset += lace
+            if lace < 255:
+                packets.append(current)
+                current = b""
+    return packets[:count]
+
+
+def _ogg_comment_fields(fileobj: IO[bytes]) -> Optional[Dict[str, List[str]]]:
+    packets = _ogg_packets(fileobj, 2)
+    if packets is None:
+        return None
+
+    ident, comment = packets
+    if ident.startswith(b"\x01vorbis") and comment.startswith(b"\x03vorbis"):
+        return _vorbis_comment_fields(comment[7:])
+    if ident.startswith(b"OpusHead") and len(ident) > 8 and ident[8] >> 4 == 0 and comment.startswith(b"OpusTags"):
+        return _vorbis_comment_fields(comment[8:])
+    return None
+
+
+def _mp4_atoms(fileobj: IO[bytes], start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """(name, payload start, atom end) for each atom in [start, end); seeks over payloads."""
+    pos = start
+    while pos + 8 <= end:
+        fileobj.seek(pos)
+        size, name = struct.unpack(">I4s", fileobj.read(8))
+        offset = 8
+        if size == 1:
+            size = struct.unpack(">Q", fileobj.read(8))[0]
+            offset = 16
+        elif size == 0:
+            size = end - pos
+        if size < offset or pos + size > end:
+            raise ValueError(f"bad atom size for {name!r}")
+        yield name, pos + offset, pos + size
+        pos += size
+
+
+def _mp4_child(fileobj: IO[bytes], start: int, end: int, name: bytes) -> Optional[Tuple[int, int]]:
+    for atom_name, payload, atom_end in _mp4_atoms(fileobj, start, end):
+        if atom_name == name:
+            return payload, atom_end
+    return None
+
+
+def _mp4_item_fields(fileobj: IO[bytes]) -> Optional[Dict[str, List[str]]]:
+    span: Optional[Tuple[int, int]] = (0, os.fstat(fileobj.fileno()).st_size)
+    for name in (b"moov", b"udta", b"meta", b"ilst"):
+        assert span is not None
+        start, end = span
+        if name == b"ilst":
+            start += 4  # "meta" is a full atom: version + flags precede its children
+        span = _mp4_child(fileobj, start, end, name)
+        if span is None:
+            return {}
+
+    start, end = span
+    if end - start > TAG_READ_LIMIT:
+        return None
+    fileobj.seek(start)
+    data = fileobj.read(end - start)
+
+    fields: Dict[str, List[str]] = {}
+    pos = 0
+    while pos + 8 <= len(data):
+        size, name = struct.unpack_from(">I4s", data, pos)
+        if size < 8 or pos + size > len(data):
+            return None
+        if name in MP4_TEXT_ITEMS or name == b"trkn":
+            values = _mp4_item_values(name, data[pos + 8:pos + size])
+            if values is None:
+                return None
+            key = MP4_TEXT_ITEMS.get(name, "tracknumber")
+            fields.setdefault(key, []).extend(values)
+        pos += size
+    return fields
+
+
+def _mp4_item_values(name: bytes, data: bytes) -> Optional[List[str]]:
+    values: List[str] = []
+    pos = 0
+    while pos < len(data):
+        if pos + 16 > len(data):
+            return None
+        size, atom_name = struct.unpack_from(">I4s", data, pos)
+        flags = int.from_bytes(data[pos + 9:pos + 12], "big")
+        chunk = data[pos + 16:pos + size]
+        if atom_name != b"data" or size < 16 or len(chunk) != size - 16:
+            return None
+        pos += size
+
+        if name == b"trkn":
+            if len(chunk) < 6:
+                return None
+            track, total = struct.unpack(">2H", chunk[2:6])
+            values.append(mp4_track_text(track, total))
+        else:
+            if flags not in (0, 1):  # implicit / UTF-8
+                return None
+            try:
+                values.append(chunk.decode("utf-8"))
+            except UnicodeDecodeError:
+                return None
+    return values
+
+
+def _id3_fields(fileobj: IO[bytes]) -> Optional[Any]:
+    """
+    mutagen's ID3 only parses the ID3v2/v1 tag blocks, not the MPEG stream,
+    so it is already a tag-only reader; _tag_values maps its frames.
+    """
+    from mutagen.id3 import ID3, ID3NoHeaderError  # type: ignore
+
+    try:
+        return ID3(fileobj)
+    except ID3NoHeaderError:
+        return {}
+    except Exception:  # noqa: BLE001
+        return None
+
+
+# (size, mtime_ns, inode): a file whose signature is unchanged is assumed to
+# still carry the tags recorded for it.
+StatSignature = Tuple[int, int, int]
+
+
+def stat_signature(path: Path) -> StatSignature:
+    st = path.stat()
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class TagCache:
+    """
+    On-disk (SQLite) record of the tags last read from each file, keyed by
+    absolute path and validated against the file's stat signature.
+
+    Safe to share between the tag-reading threads; access is serialized.
+    """
+
+    COMMIT_EVERY = 500
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tags (
+            path     TEXT PRIMARY KEY,
+            size     INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode    INTEGER NOT NULL,
+            keys     TEXT NOT NULL,
+            tags     TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._conn.executescript(self.SCHEMA)
+        self._pending = 0
+
+    def lookup(self, path: Path, signature: StatSignature, keys: Iterable[str]) -> Optional[Dict[str, str]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, inode, keys, tags FROM tags WHERE path = ?",
+                (str(path),),
+            ).fetchone()
+        if row is None or tuple(row[:3]) != signature:
+            return None
+        if not set(keys) <= set(json.loads(row[3])):
+            return None
+        tags = json.loads(row[4])
+        return {k: tags[k] for k in keys if k in tags}
+
+    def store(self, path: Path, signature: StatSignature, keys: Iterable[str], tags: Dict[str, str]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tags (path, size, mtime_ns, inode, keys, tags) VALUES (?, ?, ?, ?, ?, ?)",
+                (str(path), *signature, json.dumps(sorted(keys)), json.dumps(tags)),
+            )
+            self._pending += 1
+            if self._pending >= self.COMMIT_EVERY:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self, complete: bool = False) -> None:
+        """`complete`: the run finished planning (see LibraryIndex)."""
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+class LibraryIndex(TagCache):
+    """
+    Persistent SQLite index of a library: every album directory with the
+    tags derived from its name, and every track with its stat signature,
+    track number and current tags (paths relative to root).
+
+    Used in place of a TagCache: unchanged tracks are served from the
+    index instead of being reopened, and the run's new/changed/removed
+    tracks are counted. It also answers queries (--index-query) without
+    touching the files. With `prune`, tracks and albums the run did not
+    see are dropped on close(complete=True), so only pass it for runs that
+    see the whole library; a run that failed or was interrupted while
+    planning closes with complete=False and only commits.
+    """
+
+    VERSION = 1
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS albums (
+            dir         TEXT PRIMARY KEY,
+            artist      TEXT,
+            album       TEXT,
+            year        TEXT
+        );
+        CREATE TABLE IF NOT EXISTS tracks (
+            path        TEXT PRIMARY KEY,
+            dir         TEXT NOT NULL,
+            size        INTEGER NOT NULL,
+            mtime_ns    INTEGER NOT NULL,
+            inode       INTEGER NOT NULL,
+            tracknumber TEXT,
+            keys        TEXT NOT NULL,
+            tags        TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tracks_dir ON tracks (dir);
+    """
+
+    def __init__(self, db_path: Path, root: Path, prune: bool = False) -> None:
+        super().__init__(db_path)
+        self.root = root
+        self.prune = prune
+        meta = dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+        if meta and (meta.get("version") != str(self.VERSION) or meta.get("root") != str(root)):
+            self._conn.close()
+            raise sqlite3.DatabaseError(f"index belongs to {meta.get('root')} (version {meta.get('version')})")
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [("version", str(self.VERSION)), ("root", str(root))],
+        )
+        self._seen_tracks: set = set()
+        self._seen_albums: set = set()
+
+    def _relative(self, path: Path) -> Tuple[str, str]:
+        rel_path = path.relative_to(self.root)
+        return rel_path.as_posix(), rel_path.parent.as_posix()
+
+    def _see(self, rel_path: str, rel_dir: str) -> None:
+        """Records the track's album the first time it is seen in this run. Caller holds the lock."""
+        self._seen_tracks.add(rel_path)
+        if rel_dir in self._seen_albums:
+            return
+        self._seen_albums.add(rel_dir)
+        album_tags = derive_album_metadata(self.root / rel_dir) or {}
+        self._conn.execute(
+            "INSERT OR REPLACE INTO albums (dir, artist, album, year) VALUES (?, ?, ?, ?)",
+            (rel_dir, album_tags.get("albumartist"), album_tags.get("album"), album_tags.get("year")),
+        )
+
+    def lookup(self, path: Path, signature: StatSignature, keys: Iterable[str]) -> Optional[Dict[str, str]]:
+        rel_path, rel_dir = self._relative(path)
+        with self._lock:
+            self._see(rel_path, rel_dir)
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, inode, keys, tags FROM tracks WHERE path = ?",
+                (rel_path,),
+            ).fetchone()
+        if row is None:
+            STATS.count("index: new tracks")
+            return None
+        if tuple(row[:3]) != signature:
+            STATS.count("index: changed tracks")
+            return None
+        if not set(keys) <= set(json.loads(row[3])):
+            return None
+        STATS.count("index: unchanged tracks")
+        tags = json.loads(row[4])
+        return {k: tags[k] for k in keys if k in tags}
+
+    def store(self, path: Path, signature: StatSignature, keys: Iterable[str], tags: Dict[str, str]) -> None:
+        rel_path, rel_dir = self._relative(path)
+        track_match = TRACK_PATTERN.match(path.stem)
+        with self._lock:
+            self._see(rel_path, rel_dir)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tracks (path, dir, size, mtime_ns, inode, tracknumber, keys, tags) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    rel_path,
+                    rel_dir,
+                    *signature,
+                    track_match.group("track") if track_match else None,
+                    json.dumps(sorted(keys)),
+                    json.dumps(tags, ensure_ascii=False),
+                ),
+            )
+            self._pending += 1
+            if self._pending >= self.COMMIT_EVERY:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self, complete: bool = False) -> None:
+        with self._lock:
+            if self.prune and complete:
+                self._conn.execute("CREATE TEMP TABLE seen (path TEXT PRIMARY KEY)")
+                self._conn.executemany("INSERT OR IGNORE INTO seen (path) VALUES (?)", ((p,) for p in self._seen_tracks))
+                removed = self._conn.execute("DELETE FROM tracks WHERE path NOT IN (SELECT path FROM seen)").rowcount
+                self._conn.execute("DELETE FROM albums WHERE dir NOT IN (SELECT DISTINCT dir FROM tracks)")
+                STATS.count("index: removed tracks", removed)
+            self._conn.commit()
+            self._conn.close()
+
+
+class ParsedAudioCache:
+    """
+    Bounded LRU of mutagen objects parsed while planning, so a non-interactive
+    run can modify and save them directly instead of parsing each file twice.
+
+    An entry is only reused if the file's stat signature is unchanged; once
+    the bound is reached the least recently parsed file is re-read on apply.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._items: "OrderedDict[Path, Tuple[StatSignature, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hold(self, path: Path, signature: StatSignature, audio: Any) -> None:
+        with self._lock:
+            self._items[path] = (signature, audio)
+            self._items.move_to_end(path)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def discard(self, path: Path) -> None:
+        with self._lock:
+            self._items.pop(path, None)
+
+    def take(self, path: Path) -> Optional[Any]:
+        with self._lock:
+            item = self._items.pop(path, None)
+        if item is None:
+            return None
+
+        signature, audio = item
+        try:
+            if stat_signature(path) != signature:
+                return None
+        except OSError:
+            return None
+        return audio
+
+
+def read_tags_with_cache(
+    path: Path,
+    desired_keys: Iterable[str],
+    cache: Optional[TagCache],
+    parsed: Optional[ParsedAudioCache] = None,
+    header_only: bool = False,
+) -> Dict[str, str]:
+    """
+    read_current_tags, served from `cache` when the file is unchanged. With
+    `header_only`, the tag block is read directly (read_tags_header_only) and
+    mutagen is only used as a fallback. Files that do get parsed by mutagen
+    are offered to `parsed` for reuse by the apply phase.
+    """
+    if cache is None and parsed is None and not header_only:
+        with STATS.measure("read tags (mutagen)"):
+            return read_current_tags(path, desired_keys)
+
+    keys = list(desired_keys)
+    signature: Optional[StatSignature] = None
+    if cache is not None or parsed is not None:
+        signature = stat_signature(path)
+    if cache is not None:
+        assert signature is not None
+        current = cache.lookup(path, signature, keys)
+        if current is not None:
+            STATS.count("tag cache hits")
+            return current
+        STATS.count("tag cache misses")
+
+    current = None
+    if header_only:
+        with STATS.measure("read tags (header only)"):
+            current = read_tags_header_only(path, keys)
+        if current is None:
+            STATS.count("header-only fallbacks to mutagen")
+    if current is None:
+        with STATS.measure("read tags (mutagen)"):
+            audio = mutagen_file(path)
+            current = tags_from_audio(audio, keys)
+        if parsed is not None and audio is not None:
+            assert signature is not None
+            parsed.hold(path, signature, audio)
+    if cache is not None:
+        assert signature is not None
+        cache.store(path, signature, keys, current)
+    return current
+
+
+def iter_metadata_actions(
+    root: Path,
+    files: Optional[Iterable[Path]] = None,
+    cache: Optional[TagCache] = None,
+    jobs: int = 1,
+    parsed: Optional[ParsedAudioCache] = None,
+    header_only: bool = False,
+    walk_jobs: int = 1,
+) -> Iterator[MetadataAction]:
+    """
+    Plans tag updates, yielding each action as soon as its tags are read.
+    `files` are root-relative paths already known to be regular files (e.g.
+    from a shared walk); without it the tree is walked on `walk_jobs` threads.
+    With a `cache`, files whose stat signature is unchanged are not reopened.
+    `jobs` > 1 reads tags on that many threads; the result order is the same
+    as with a single thread. Parsed files that need updates stay in `parsed`.
+    `header_only` reads tag blocks directly instead of parsing each file.
+    """
+    if files is None:
+        files = (entry.path for entry in iter_library(root, walk_jobs=walk_jobs) if not entry.is_dir)
+
+    def read(candidate: Tuple[Path, Dict[str, str]]) -> Tuple[Path, Dict[str, str], Dict[str, str]]:
+        rel_path, updates = candidate
+        current = read_tags_with_cache(root / rel_path, updates.keys(), cache, parsed, header_only)
+        return rel_path, updates, current
+
+    for rel_path, updates, current in ordered_map(read, metadata_candidates(root, files), jobs):
+        action = metadata_action(root, rel_path, updates, current, parsed)
+        if action is not None:
+            yield action
+
+
+def metadata_candidates(root: Path, files: Iterable[Path]) -> Iterator[Tuple[Path, Dict[str, str]]]:
+    """
+    (path, desired tags) for each file that is audio in the library layout.
+    Files arrive grouped by directory, so each album directory is parsed
+    once and only the track number is derived per file.
+    """
+    album_dir: Optional[Path] = None
+    album_tags: Optional[Dict[str, str]] = None
+    for rel_path in files:
+        if not has_audio_extension(rel_path):
+            STATS.skip("metadata: not an audio file")
+            continue
+
+        with STATS.measure("derive tags", track_io=False):
+            if rel_path.parent != album_dir:
+                album_dir = rel_path.parent
+                album_tags = derive_album_metadata(root / album_dir)
+            updates = derive_track_metadata(album_tags, rel_path.stem) if album_tags is not None else None
+        if updates is None:
+            STATS.skip("metadata: path not in library layout")
+            continue
+        yield rel_path, drop_unsupported_keys(rel_path, updates)
+
+
+def metadata_action(
+    root: Path,
+    rel_path: Path,
+    updates: Dict[str, str],
+    current: Dict[str, str],
+    parsed: Optional[ParsedAudioCache] = None,
+) -> Optional[MetadataAction]:
+    """The action for the tags that differ from `current`; None if all match."""
+    effective_updates = {k: v for k, v in updates.items() if current.get(k, "") != v}
+    if not effective_updates:
+        STATS.skip("metadata: tags already up to date")
+        if parsed is not None:
+            parsed.discard(root / rel_path)
+        return None
+
+    return MetadataAction(
+        file_path=rel_path,
+        updates=effective_updates,
+        current=current,
+    )
+
+
+def gather_metadata_actions(
+    root: Path,
+    files: Optional[Iterable[Path]] = None,
+    cache: Optional[TagCache] = None,
+    jobs: int = 1,
+    parsed: Optional[ParsedAudioCache] = None,
+    header_only: bool = False,
+    walk_jobs: int = 1,
+) -> List[MetadataAction]:
+    return list(
+        iter_metadata_actions(
+            root,
+            files=files,
+            cache=cache,
+            jobs=jobs,
+            parsed=parsed,
+            header_only=header_only,
+            walk_jobs=walk_jobs,
+        )
+    )
+
+
+def print_metadata_preview(actions: Iterable[MetadataAction]) -> None:
+    actions = list(actions)
+    if not actions:
+        print("No metadata updates required.")
+        return
+
+    print("Metadata update preview")
+    print("=" * 23)
+    for idx, action in enumerate(sorted(actions, key=lambda a: str(a.file_path)), start=1):
+        print_metadata_action(idx, action)
+
+    print(f"\nTotal files to update: {len(actions)}")
+
+
+def print_metadata_action(idx: int, action: MetadataAction) -> None:
+    print(f"\n[{idx}] {action.file_path}")
+    print("    tag          current                      -> new")
+    print("    -------------------------------------------------------------")
+    updates, current = action.updates, action.current  # each access unpacks a fresh dict
+    for key in sorted(updates):
+        print(f"    {key:<12} {current.get(key, '')[:28]:<28} -> {updates[key]}")
+
+
+# How a tag save changed the file (write_metadata_action's result).
+SAVE_IN_PLACE = "in place"  # the tag block kept its size; audio data untouched
+SAVE_REWRITE = "rewrite"  # the tag block was resized, so the file was rewritten
+SAVE_DEFERRED = "deferred"  # would have been a rewrite; nothing was written
+
+
+class RewriteDeferred(Exception):
+    pass
+
+
+class TagPadding:
+    """
+    mutagen padding callback for one save. Sees the space the new tag leaves
+    in the old block (negative if it outgrew it) and picks the padding to
+    write, which decides whether the file is rewritten.
+
+    Without `reserve` or `defer` it only records mutagen's default choice.
+    Otherwise existing padding is always kept, so a tag that fits is saved in
+    place, and a tag that outgrows it gets `reserve` bytes so the next saves
+    fit; with `defer` it raises RewriteDeferred before anything is written.
+    """
+
+    __slots__ = ("reserve", "defer", "rewrote")
+
+    def __init__(self, reserve: Optional[int] = None, defer: bool = False) -> None:
+        self.reserve = reserve
+        self.defer = defer
+        self.rewrote = False
+
+    def __call__(self, info: Any) -> int:
+        if self.reserve is None and not self.defer:
+            padding = info.get_default_padding()
+        elif info.padding >= 0:
+            padding = info.padding
+        elif self.defer:
+            raise RewriteDeferred()
+        else:
+            padding = self.reserve if self.reserve is not None else info.get_default_padding()
+        self.rewrote = padding != info.padding
+        return padding
+
+
+def write_metadata_action(
+    root: Path,
+    action: MetadataAction,
+    parsed: Optional[ParsedAudioCache] = None,
+    tag_padding: Optional[int] = None,
+    defer_rewrites: bool = False,
+) -> Optional[str]:
+    """
+    Writes one action's tags and returns SAVE_IN_PLACE, SAVE_REWRITE or
+    SAVE_DEFERRED (see TagPadding), or None if mutagen does not support the
+    file. Module-level so process-pool workers can run it.
+    """
+    from mutagen.apev2 import APEv2  # type: ignore
+
+    file_path = root / action.file_path
+    audio = parsed.take(file_path) if parsed is not None else None
+    if audio is None:
+        audio = mutagen_file(file_path)
+    if audio is None:
+        return None
+
+    set_tags(audio, action.updates)
+    if isinstance(audio.tags, APEv2):
+        # APEv2 sits at the end of the file and has no padding; the audio
+        # data in front of it is never moved.
+        audio.save()
+        return SAVE_IN_PLACE
+
+    padding = TagPadding(tag_padding, defer_rewrites)
+    try:
+        audio.save(padding=padding)
+    except RewriteDeferred:
+        return SAVE_DEFERRED
+    return SAVE_REWRITE if padding.rewrote else SAVE_IN_PLACE
+
+
+def report_tag_save(action: MetadataAction, outcome: Optional[str], show_outcome: bool) -> bool:
+    """Prints one save result; returns whether the file was written."""
+    if outcome is None:
+        print(f"[SKIP] unsupported format: {action.file_path}")
+        STATS.skip("metadata: unsupported format")
+        return False
+    if outcome == SAVE_DEFERRED:
+        print(f"[DEFER] tags outgrow padding: {action.file_path}")
+        STATS.count("tag saves deferred")
+        return False
+
+    STATS.count(f"tag saves {outcome}")
+    if show_outcome:
+        print(f"[OK] updated tags ({outcome}): {action.file_path}")
+    else:
+        print(f"[OK] updated tags: {action.file_path}")
+    return True
+
+
+class TagSaveRecorder:
+    """
+    Per-file bookkeeping after a tag save, shared by apply_metadata_actions
+    and the --async-io engine: reports the outcome, stores the written tags
+    in the cache, records the file in the journal and keeps saves deferred
+    by TagPadding for the rewrite phase.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        cache: Optional[TagCache],
+        journal: Optional[ApplyJournal],
+        show_outcome: bool,
+    ) -> None:
+        self.root = root
+        self.cache = cache
+        self.journal = journal
+        self.show_outcome = show_outcome
+        self.applied = 0
+        self.deferred: List[MetadataAction] = []
+
+    def record(self, action: MetadataAction, outcome: Optional[str], signature: Optional[StatSignature] = None) -> None:
+        """`signature`: the saved file's stat, if the caller already has it."""
+        if outcome == SAVE_DEFERRED:
+            self.deferred.append(action)
+        if not report_tag_save(action, outcome, self.show_outcome):
+            return
+
+        self.applied += 1
+        if self.cache is not None:
+            file_path = self.root / action.file_path
+            tags = {**action.current, **action.updates}
+            self.cache.store(file_path, signature or stat_signature(file_path), tags.keys(), tags)
+        if self.journal is not None:
+            self.journal.tagged(action)
+
+    def take_deferred(self) -> List[MetadataAction]:
+        """Starts the rewrite phase: returns and clears the deferred saves."""
+        rewrites, self.deferred = self.deferred, []
+        if rewrites:
+            print(f"\nRewriting {len(rewrites)} file(s) whose tags outgrew their padding...")
+        return rewrites
+
+
+def apply_metadata_actions(
+    root: Path,
+    actions: Iterable[MetadataAction],
+    cache: Optional[TagCache] = None,
+    write_jobs: int = 1,
+    parsed: Optional[ParsedAudioCache] = None,
+    journal: Optional[ApplyJournal] = None,
+    tag_padding: Optional[int] = None,
+    defer_rewrites: bool = False,
+    rewrite_pause: float = 0.0,
+) -> int:
+    """
+    Applies tag updates in path order. `write_jobs` > 1 saves files on a
+    process pool (tag rewrites are CPU-heavy); workers report each result back
+    and this process prints them in the same order as a serial run.
+    Objects held in `parsed` are saved directly (serial path only).
+    Saved files are recorded in `journal`.
+
+    With `defer_rewrites`, saves that would rewrite a whole file are left
+    for a second, serial phase that sleeps `rewrite_pause` seconds between
+    files. `tag_padding` is passed to TagPadding.
+    """
+    ordered = sorted(actions, key=lambda a: str(a.file_path))
+    if write_jobs > 1:
+        parsed = None
+    recorder = TagSaveRecorder(root, cache, journal, show_outcome=tag_padding is not None or defer_rewrites)
+
+    def run_phase(batch: List[MetadataAction], results: Iterable[Any]) -> None:
+        for action, result in zip(batch, results):
+            outcome = result
+            if STATS.enabled:
+                outcome, (seconds, bytes_read, bytes_written) = result
+                STATS.add("write tags", seconds, 1, bytes_read, bytes_written)
+            recorder.record(action, outcome)
+
+    write = partial(
+        write_metadata_action, root, parsed=parsed, tag_padding=tag_padding, defer_rewrites=defer_rewrites
+    )
+    if STATS.enabled:
+        write = partial(measured_call, write)
+    run_phase(ordered, ordered_map(write, ordered, write_jobs, ProcessPoolExecutor))
+
+    rewrites = recorder.take_deferred()
+    if rewrites:
+        rewrite = partial(write_metadata_action, root, tag_padding=tag_padding)
+        if STATS.enabled:
+            rewrite = partial(measured_call, rewrite)
+
+        def throttled() -> Iterator[Any]:
+            for idx, action in enumerate(rewrites):
+                if idx and rewrite_pause > 0:
+                    time.sleep(rewrite_pause)
+                yield rewrite(action)
+
+        run_phase(rewrites, throttled())
+
+    return recorder.applied
+
+
+@dataclass(frozen=True)
+class MetadataOptions:
+    tag_cache: Optional[Path] = None  # TagCache database
+    jobs: int = 1  # tag-reading threads
+    walk_jobs: int = 1  # directory-listing threads when the tree is walked here
+    write_jobs: int = 1  # tag-writing processes
+    parsed_cache_size: int = 0  # ParsedAudioCache bound for non-interactive runs
+    header_only: bool = False  # read_tags_header_only before mutagen
+    stream: bool = False  # print/apply per album directory while planning
+    plan_in: Optional[Path] = None  # apply a plan file instead of planning
+    plan_out: Optional[Path] = None  # write the plan to a file instead of applying
+    index: Optional[Path] = None  # LibraryIndex database, used as the tag cache
+    index_full_scan: bool = False  # the run sees every file, so the index can drop missing ones
+    tag_padding: Optional[int] = None  # bytes reserved when a tag outgrows its block (TagPadding)
+    defer_rewrites: bool = False  # save tags that force a full file rewrite in a later phase
+    rewrite_pause: float = 0.0  # seconds between deferred rewrites
+
+
+def open_tag_cache(root: Path, options: MetadataOptions) -> Optional[TagCache]:
+    if options.index is not None:
+        return LibraryIndex(options.index, root, prune=options.index_full_scan)
+    if options.tag_cache is not None:
+        return TagCache(options.tag_cache)
+    return None
+
+
+# Streaming applies once this many actions are pending (bounds memory and
+# keeps them within the default parsed-object LRU).
+STREAM_APPLY_BATCH = 256
+
+
+def run_metadata(
+    root: Path,
+    yes: bool,
+    files: Optional[Iterable[Path]] = None,
+    options: Optional[MetadataOptions] = None,
+    journal: Optional[ApplyJournal] = None,
+) -> int:
+    """
+    Plans, previews and applies tag updates. Files that `journal` already
+    records as saved are skipped before their tags are read; newly saved
+    files are recorded in it.
+    """
+    if importlib.util.find_spec("mutagen") is None:
+        print("Error: missing dependency 'mutagen'. Install it with: pip install mutagen")
+        return 1
+
+    if options is None:
+        options = MetadataOptions()
+
+    planned: List[MetadataAction] = []
+    signatures: Dict[Path, StatSignature] = {}
+    if options.plan_in is not None:
+        try:
+            planned, signatures = read_plan(options.plan_in, "metadata", root)
+        except (OSError, ValueError, ImportError) as exc:
+            print(f"Error: cannot read plan {options.plan_in}: {exc}")
+            return 1
+
+    try:
+        cache = open_tag_cache(root, options)
+    except sqlite3.Error as exc:
+        print(f"Error: cannot open tag cache {options.index or options.tag_cache}: {exc}")
+        return 1
+
+    # Without a prompt the plan is applied immediately, so parsed files can be
+    # kept for the save (worker processes cannot share them).
+    parsed: Optional[ParsedAudioCache] = None
+    if yes and options.write_jobs == 1 and options.parsed_cache_size > 0 and options.plan_out is None:
+        parsed = ParsedAudioCache(options.parsed_cache_size)
+
+    def apply(batch: Iterable[MetadataAction]) -> int:
+        if options.plan_in is not None:
+            batch = unchanged_since_plan(root, batch, signatures)
+        return apply_metadata_actions(
+            root,
+            batch,
+            cache=cache,
+            write_jobs=options.write_jobs,
+            parsed=parsed,
+            journal=journal,
+            tag_padding=options.tag_padding,
+            defer_rewrites=options.defer_rewrites,
+            rewrite_pause=options.rewrite_pause,
+        )
+
+    if options.plan_in is not None:
+        if journal is not None:
+            planned = [action for action in planned if not journal.was_tagged(action.file_path)]
+        actions: Iterator[MetadataAction] = iter(planned)
+    else:
+        if journal is not None:
+            if files is None:
+                files = (entry.path for entry in iter_library(root, walk_jobs=options.walk_jobs) if not entry.is_dir)
+            files = journal.pending_files(files)
+        actions = iter_metadata_actions(
+            root,
+            files=files,
+            cache=cache,
+            jobs=options.jobs,
+            parsed=parsed,
+            header_only=options.header_only,
+            walk_jobs=options.walk_jobs,
+        )
+
+    rc: Optional[int] = None
+    try:
+        if options.plan_out is not None:
+            rc = _write_metadata_plan(root, actions, options.plan_out)
+        elif options.stream and options.plan_in is None:
+            rc = _run_metadata_streaming(actions, yes, apply)
+        else:
+            rc = _run_metadata(actions, yes, apply)
+        return rc
+    finally:
+        if cache is not None:
+            # Only a run that saw every file may drop the ones it did not see.
+            cache.close(complete=rc == 0)
+
+
+def _run_metadata(
+    actions_iter: Iterator[MetadataAction],
+    yes: bool,
+    apply: Callable[[Iterable[MetadataAction]], int],
+) -> int:
+    try:
+        actions = list(actions_iter)
+    except Exception as exc:  # noqa: BLE001
+        print(f"Error while reading media files: {exc}")
+        return 1
+
+    print_metadata_preview(actions)
+    if not actions:
+        return 0
+
+    if not yes:
+        answer = input("\nApply these metadata changes? [y/N]: ").strip().lower()
+        if answer not in {"y", "yes"}:
+            print("Aborted. No changes applied.")
+            return 0
+
+    print("\nApplying metadata updates...")
+    try:
+        applied = apply(actions)
+    except Exception as exc:  # noqa: BLE001
+        print(f"Error while writing media files: {exc}")
+        return 1
+
+    print(f"\nDone. Updated {applied} file(s).")
+    return 0
+
+
+def _write_metadata_plan(root: Path, actions_iter: Iterator[MetadataAction], plan_out: Path) -> int:
+    try:
+        actions = list(actions_iter)
+    except Exception as exc:  # noqa: BLE001
+        print(f"Error while reading media files: {exc}")
+        return 1
+
+    print_metadata_preview(actions)
+    return write_plan_or_report(plan_out, "metadata", root, actions)
+
+
+def _run_metadata_streaming(
+    actions_iter: Iterator[MetadataAction],
+    yes: bool,
+    apply: Callable[[Iterable[MetadataAction]], int],
+) -> int:
+    """
+    Prints the preview one album directory at a time (sorted within it) as
+    tags are read. With `yes`, pending actions are applied every
+    STREAM_APPLY_BATCH files; otherwise the plan is kept for the usual
+    confirmation at the end.
+    """
+    groups = groupby(actions_iter, key=lambda a: a.parent)
+    pending: List[MetadataAction] = []
+    total = 0
+    applied = 0
+
+    while True:
+        try:
+            item = next(groups, None)
+            if item is None:
+                break
+            group = sorted(item[1], key=lambda a: str(a.file_path))
+        except Exception as exc:  # noqa: BLE001
+            print(f"Error while reading media files: {exc}")
+            return 1
+
+        if total == 0:
+            print("Metadata update preview")
+            print("=" * 23)
+        for action in group:
+            total += 1
+            print_metadata_action(total, action)
+        pending.extend(group)
+
+        if yes and len(pending) >= STREAM_APPLY_BATCH:
+            print()
+            try:
+                applied += apply(pending)
+            except Exception as exc:  # noqa: BLE001
+                print(f"Error while writing media files: {exc}")
+                return 1
+            pending = []
+
+    if total == 0:
+        print("No metadata updates required.")
+        return 0
+
+    print(f"\nTotal files to update: {total}")
+
+    if not yes:
+        answer = input("\nApply these metadata changes? [y/N]: ").strip().lower()
+        if answer not in {"y", "yes"}:
+            print("Aborted. No changes applied.")
+            return 0
+
+    if pending:
+        print("\nApplying metadata updates...")
+        try:
+            applied += apply(pending)
+        except Exception as exc:  # noqa: BLE001
+            print(f"Error while writing media files: {exc}")
+            return 1
+
+    print(f"\nDone. Updated {applied} file(s).")
+    return 0
+
+
+# ----------------------------
+# Plan files (--plan-out / --plan-in)
+# ----------------------------
+
+PLAN_VERSION = 1
+
+
+def open_plan(path: Path, mode: str) -> IO[str]:
+    """
+    Opens a plan file for text "r" or "w". A .gz suffix means gzip, .zst
+    means zstd (needs the zstandard package); anything else is plain text.
+    """
+    suffix = path.suffix.lower()
+    if suffix == ".gz":
+        import gzip
+
+        return gzip.open(path, mode + "t", encoding="utf-8")  # type: ignore[return-value]
+    if suffix == ".zst":
+        if importlib.util.find_spec("zstandard") is None:
+            raise ImportError("missing dependency 'zstandard'. Install it with: pip install zstandard")
+        import zstandard  # type: ignore
+
+        return zstandard.open(path, mode + "t", encoding="utf-8")
+    return path.open(mode, encoding="utf-8")
+
+
+def _plan_record(root: Path, kind: str, action: Any) -> Optional[List[Any]]:
+    """
+    One plan line, ending in the source's stat signature:
+      rename:   ["f" | "d", source, target name, size, mtime_ns, inode]
+      metadata: [path, updates, current, size, mtime_ns, inode]
+    None if the source can no longer be stat'ed.
+    """
+    path = action.source if kind == "rename" else action.file_path
+    try:
+        signature = stat_signature(root / path)
+    except OSError:
+        return None
+    if kind == "rename":
+        return ["d" if action.is_dir else "f", path.as_posix(), action.target_name, *signature]
+    return [path.as_posix(), action.updates, action.current, *signature]
+
+
+def write_plan(path: Path, kind: str, root: Path, actions: Iterable[Any]) -> int:
+    """
+    Writes `actions` ("rename" or "metadata") as a line-delimited JSON plan:
+    a header line, then one _plan_record per action. Returns the number of
+    actions written.
+    """
+    written = 0
+    tmp_path = path.with_name(path.name + ".tmp" + path.suffix)
+    with open_plan(tmp_path, "w") as fileobj:
+        header = {"plan": kind, "version": PLAN_VERSION, "root": str(root)}
+        fileobj.write(json.dumps(header) + "\n")
+        for action in actions:
+            record = _plan_record(root, kind, action)
+            if record is None:
+                STATS.skip("plan: source vanished while planning")
+                continue
+            fileobj.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            written += 1
+    os.replace(tmp_path, path)
+    return written
+
+
+def write_plan_or_report(path: Path, kind: str, root: Path, actions: Iterable[Any]) -> int:
+    try:
+        written = write_plan(path, kind, root, actions)
+    except (OSError, ImportError) as exc:
+        print(f"Error: cannot write plan {path}: {exc}")
+        return 1
+    print(f"\nWrote {written} planned action(s) to {path}. Apply them later with --plan-in {path}.")
+    return 0
+
+
+def read_plan(path: Path, kind: str, root: Path) -> Tuple[List[Any], Dict[Path, StatSignature]]:
+    """
+    Reads a plan written by write_plan. Returns the actions and, per source
+    path, the stat signature it had when planned.
+    """
+    actions: List[Any] = []
+    signatures: Dict[Path, StatSignature] = {}
+    with open_plan(path, "r") as fileobj:
+        header = json.loads(fileobj.readline() or "{}")
+        if header.get("version") != PLAN_VERSION or header.get("plan") not in ("rename", "metadata"):
+            raise ValueError("not a plan file")
+        if header["plan"] != kind:
+            raise ValueError(f"it is a {header['plan']} plan")
+        if header.get("root") != str(root):
+            print(f"[WARN] plan was made for {header.get('root')}; applying to {root}")
+
+        for line in fileobj:
+            record = json.loads(line)
+            if kind == "rename":
+                is_dir, source_text, target_name, *signature = record
+                source = Path(source_text)
+                actions.append(
+                    RenameAction(kind="dir" if is_dir == "d" else "file", source=source, target=source.with_name(target_name))
+                )
+            else:
+                source_text, updates, current, *signature = record
+                source = Path(source_text)
+                actions.append(MetadataAction(file_path=source, updates=updates, current=current))
+            signatures[source] = tuple(signature)  # type: ignore[assignment]
+    return actions, signatures
+
+
+def unchanged_since_plan(root: Path, actions: Iterable[T], signatures: Dict[Path, StatSignature]) -> List[T]:
+    """
+    The actions whose source still has its planned stat signature. Only the
+    inode is compared for directories, whose size and mtime change as the
+    files inside them are renamed.
+    """
+    unchanged: List[T] = []
+    for action in actions:
+        if isinstance(action, RenameAction):
+            path, is_dir = action.source, action.is_dir
+        else:
+            path, is_dir = action.file_path, False  # type: ignore[attr-defined]
+        try:
+            current = stat_signature(root / path)
+        except OSError:
+            current = None
+        planned = signatures[path]
+        if current is not None and (current[2] == planned[2] if is_dir else current == planned):
+            unchanged.append(action)
+            continue
+        print(f"[SKIP] changed since planned: {path}")
+        STATS.skip("plan: source changed since planned")
+    return unchanged
+
+
+# ----------------------------
+# Apply journal (--journal / --resume / --rollback)
+# ----------------------------
+
+class ApplyJournal:
+    """
+    Append-only JSON-lines record of applied renames and tag saves, so an
+    interrupted run can be resumed (--resume skips what it records) or its
+    renames undone (--rollback).
+
+    Every rename is first recorded as an intent, then confirmed once it
+    succeeded or withdrawn if it was skipped, so a killed run never hides a
+    rename: when an incomplete journal is reopened, each intent it left open
+    is settled against the directory listing. Each record is
+    flushed as it is written; fsync runs every SYNC_EVERY records and on
+    close, so only a power loss can drop the last batch. Dropped tag saves
+    are redone on resume, which is harmless (they are idempotent).
+    A run that finishes appends a "complete" line.
+    """
+
+    VERSION = 1
+    SYNC_EVERY = 256
+
+    def __init__(self, path: Path, root: Path, resume: bool = False) -> None:
+        self.path = path
+        self.root = root
+        self.renames: List[Tuple[bool, str, str]] = []  # (is_dir, source, target name), in order
+        self.unconfirmed: set = set()  # (source, target name) of renames that may not have happened
+        self.tagged_files: set = set()
+        self.complete = False
+        self._unsynced = 0
+
+        exists = path.exists()
+        if exists:
+            self._load()
+            if not resume and not self.complete:
+                raise ValueError(
+                    f"journal {path} is from an interrupted run; pass --resume to continue it "
+                    "or --rollback to undo its renames"
+                )
+        if not resume or not exists:
+            self.renames, self.unconfirmed, self.tagged_files, self.complete = [], set(), set(), False
+            self._file = path.open("w", encoding="utf-8")
+            self._append({"journal": "prep_files", "version": self.VERSION, "root": str(root)})
+        else:
+            self._file = path.open("a", encoding="utf-8")
+            if not self.complete:
+                self._settle_intents()
+        self._done_renames = {(source, target) for _, source, target in self.renames} - self.unconfirmed
+
+    def _load(self) -> None:
+        with self.path.open("r", encoding="utf-8") as fileobj:
+            lines = fileobj.read().splitlines()
+        header = json.loads(lines[0]) if lines else {}
+        if header.get("journal") != "prep_files" or header.get("version") != self.VERSION:
+            raise ValueError(f"{self.path} is not a journal")
+        if header.get("root") != str(self.root):
+            raise ValueError(f"journal {self.path} belongs to {header.get('root')}")
+
+        renames: Dict[Tuple[str, str], bool] = {}  # (source, target name) -> is_dir, in order
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # torn last line from a crash
+            if record[0] in ("intent", "rename", "skip"):
+                key = (record[2], record[3])
+                if record[0] == "skip":
+                    if key in self.unconfirmed:
+                        self.unconfirmed.discard(key)
+                        del renames[key]
+                elif key not in renames:
+                    renames[key] = record[1] == "d"
+                    if record[0] == "intent":
+                        self.unconfirmed.add(key)
+                elif record[0] == "rename":
+                    self.unconfirmed.discard(key)
+            elif record[0] == "tags":
+                self.tagged_files.add(record[1])
+            elif record[0] == "complete":
+                self.complete = True
+        self.renames = [(is_dir, source, target) for (source, target), is_dir in renames.items()]
+
+    def _settle_intents(self) -> None:
+        """
+        Confirms each open intent whose rename is visible on disk (target
+        present, source gone) and withdraws the others. Intents whose
+        directory cannot be listed stay open.
+        """
+        is_dir = {(source, target): d for d, source, target in self.renames}
+        withdrawn = set()
+        for source, target in sorted(self.unconfirmed):
+            action = RenameAction(kind="file", source=Path(source), target=Path(source).with_name(target))
+            try:
+                names = set(os.listdir(self.root / action.parent))
+            except OSError:
+                continue
+            kind = "d" if is_dir[source, target] else "f"
+            if action.target_name in names and action.source_name not in names:
+                self._append(["rename", kind, source, target])
+            else:
+                self._append(["skip", kind, source, target])
+                withdrawn.add((source, target))
+                STATS.skip("journal: rename never happened")
+            self.unconfirmed.discard((source, target))
+        self.renames = [entry for entry in self.renames if (entry[1], entry[2]) not in withdrawn]
+        self.sync()
+
+    def _append(self, record: Any) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.SYNC_EVERY:
+            self.sync()
+
+    def sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def pending_renames(self, actions: Iterable[RenameAction]) -> List[RenameAction]:
+        pending: List[RenameAction] = []
+        for action in actions:
+            if (action.source.as_posix(), action.target_name) in self._done_renames:
+                print(f"[SKIP] already applied: {action.relative_source}")
+                STATS.skip("journal: already applied")
+            else:
+                pending.append(action)
+        return pending
+
+    def pending_files(self, files: Iterable[Path]) -> Iterator[Path]:
+        for rel_path in files:
+            if rel_path.as_posix() in self.tagged_files:
+                STATS.skip("journal: already applied")
+            else:
+                yield rel_path
+
+    def was_tagged(self, rel_path: Path) -> bool:
+        return rel_path.as_posix() in self.tagged_files
+
+    def renaming(self, actions: Iterable[RenameAction]) -> None:
+        """Records renames about to be attempted."""
+        for action in actions:
+            self._append(["intent", "d" if action.is_dir else "f", action.source.as_posix(), action.target_name])
+
+    def renamed(self, action: RenameAction) -> None:
+        self._append(["rename", "d" if action.is_dir else "f", action.source.as_posix(), action.target_name])
+
+    def skipped(self, action: RenameAction) -> None:
+        """Withdraws the intent of a rename that was not performed."""
+        self._append(["skip", "d" if action.is_dir else "f", action.source.as_posix(), action.target_name])
+
+    def tagged(self, action: MetadataAction) -> None:
+        self._append(["tags", action.file_path.as_posix()])
+
+    def close(self, complete: bool = False) -> None:
+        if complete:
+            self._append(["complete"])
+        self.sync()
+        self._file.close()
+
+
+def run_rollback(root: Path, journal_path: Path) -> int:
+    """
+    Undoes the renames recorded in a journal, newest first. Tag saves cannot
+    be undone and are left alone. The journal is rewritten without the
+    renames that were reverted.
+    """
+    try:
+        journal = ApplyJournal(journal_path, root, resume=True)
+    except (OSError, ValueError) as exc:
+        print(f"Error: cannot open journal {journal_path}: {exc}")
+        return 1
+    journal.close()
+
+    if not journal.renames:
+        print("Nothing to roll back.")
+        return 0
+
+    kept: List[Tuple[bool, str, str]] = []
+    reverted = 0
+    for is_dir, source, target_name in reversed(journal.renames):
+        action = RenameAction(kind="dir" if is_dir else "file", source=Path(source), target=Path(source).with_name(target_name))
+        if (source, target_name) in journal.unconfirmed:
+            if journal.complete:
+                # A finished run recorded every outcome, so this was never applied.
+                STATS.skip("journal: rename never happened")
+                continue
+            # Opening the journal could not settle it (its directory was unreadable).
+            print(f"[SKIP] cannot tell whether this rename happened: {action.relative_source}")
+            kept.append((is_dir, source, target_name))
+            continue
+        # Undo = rename target back to source.
+        undo = RenameAction(kind=action.kind, source=action.target, target=action.source)
+        skipped = rename_in_directory(root, undo.parent, [undo])[0]
+        if report_rename(undo, skipped):
+            reverted += 1
+        else:
+            kept.append((is_dir, source, target_name))
+
+    # Renames that could not be reverted stay, and keep the run incomplete.
+    with journal_path.open("w", encoding="utf-8") as fileobj:
+        fileobj.write(json.dumps({"journal": "prep_files", "version": ApplyJournal.VERSION, "root": str(root)}) + "\n")
+        for is_dir, source, target_name in reversed(kept):
+            kind = "intent" if (source, target_name) in journal.unconfirmed else "rename"
+            fileobj.write(json.dumps([kind, "d" if is_dir else "f", source, target_name], ensure_ascii=False) + "\n")
+        for rel_path in sorted(journal.tagged_files):
+            fileobj.write(json.dumps(["tags", rel_path], ensure_ascii=False) + "\n")
+        if not kept:
+            fileobj.write(json.dumps(["complete"]) + "\n")
+
+    print(f"\nDone. Rolled back {reverted} rename(s).")
+    return 0 if not kept else 1
+
+
+# ----------------------------
+# Sharded runs (--shard / --merge)
+# ----------------------------
+
+def merge_stats_reports(reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Adds up --stats-json reports from the shards of one run. Wall time is
+    the slowest shard's, since shards run side by side.
+    """
+    phases: Dict[str, Counter] = {}
+    counters: Counter = Counter()
+    skips: Counter = Counter()
+    for report in reports:
+        for name, phase in report["phases"].items():
+            phases.setdefault(name, Counter()).update(phase)
+        counters.update(report["counters"])
+        skips.update(report["skips"])
+
+    return {
+        "version": 1,
+        "mode": reports[0].get("mode"),
+        "root": reports[0].get("root"),
+        "shards": sorted(report["shard"] for report in reports if "shard" in report),
+        "wall_seconds": max(report["wall_seconds"] for report in reports),
+        "phases": {
+            name: {key: round(value, 6) if key == "seconds" else value for key, value in phase.items()}
+            for name, phase in sorted(phases.items())
+        },
+        "counters": dict(sorted(counters.items())),
+        "skips": dict(sorted(skips.items())),
+    }
+
+
+def merge_plans(inputs: List[Path], output: Path) -> int:
+    """Concatenates plan files of the same kind under one header; returns the action count."""
+    header: Optional[Dict[str, Any]] = None
+    written = 0
+    tmp_path = output.with_name(output.name + ".tmp" + output.suffix)
+    with open_plan(tmp_path, "w") as out:
+        for path in inputs:
+            with open_plan(path, "r") as fileobj:
+                part = json.loads(fileobj.readline() or "{}")
+                if part.get("version") != PLAN_VERSION or part.get("plan") not in ("rename", "metadata"):
+                    raise ValueError(f"{path} is not a plan file")
+                if header is None:
+                    header = part
+                    out.write(json.dumps(header) + "\n")
+                elif part["plan"] != header["plan"]:
+                    raise ValueError(f"{path} is a {part['plan']} plan, not {header['plan']}")
+                elif part.get("root") != header.get("root"):
+                    print(f"[WARN] {path} was planned for {part.get('root')}, not {header.get('root')}")
+                for line in fileobj:
+                    out.write(line)
+                    written += 1
+    os.replace(tmp_path, output)
+    return written
+
+
+def run_merge(inputs: List[Path], output: Path) -> int:
+    """
+    Merges the --stats-json reports or --plan-out plans written by the
+    shards of a run into `output`. The kind is taken from the first input.
+    """
+    try:
+        with open_plan(inputs[0], "r") as fileobj:
+            first_line = fileobj.readline()
+        try:
+            is_plan = "plan" in json.loads(first_line)
+        except ValueError:
+            is_plan = False  # stats reports are indented, so their first line is just "{"
+        if is_plan:
+            written = merge_plans(inputs, output)
+            print(f"Merged {written} planned action(s) from {len(inputs)} plan(s) into {output}.")
+            return 0
+
+        reports = [json.loads(path.read_text(encoding="utf-8")) for path in inputs]
+        if any("phases" not in report for report in reports):
+            raise ValueError("inputs must all be --stats-json reports or all be --plan-out plans")
+        merged = merge_stats_reports(reports)
+        output.write_text(json.dumps(merged, indent=2) + "\n", encoding="utf-8")
+    except (OSError, ValueError, KeyError, ImportError) as exc:
+        print(f"Error: cannot merge: {exc}")
+        return 1
+
+    print(f"Merged {len(reports)} stats report(s) into {output}.")
+    print_stats_summary(merged)
+    return 0
+
+
+# ----------------------------
+# Library index queries (--index-query)
+# ----------------------------
+
+INDEX_QUERIES: Dict[str, Tuple[str, str]] = {
+    "summary": (
+        "Albums and tracks in the index",
+        "SELECT (SELECT COUNT(*) FROM albums), (SELECT COUNT(*) FROM tracks)",
+    ),
+    "inconsistent-albumartist": (
+        "Albums whose tracks do not all carry the same albumartist tag",
+        "SELECT dir, COUNT(DISTINCT COALESCE(json_extract(tags, '$.albumartist'), '')) AS n, "
+        "GROUP_CONCAT(DISTINCT COALESCE(json_extract(tags, '$.albumartist'), '')) "
+        "FROM tracks GROUP BY dir HAVING n > 1 ORDER BY dir",
+    ),
+    "inconsistent-album": (
+        "Albums whose tracks do not all carry the same album tag",
+        "SELECT dir, COUNT(DISTINCT COALESCE(json_extract(tags, '$.album'), '')) AS n, "
+        "GROUP_CONCAT(DISTINCT COALESCE(json_extract(tags, '$.album'), '')) "
+        "FROM tracks GROUP BY dir HAVING n > 1 ORDER BY dir",
+    ),
+    "tags-differ-from-path": (
+        "Tracks whose album/albumartist/tracknumber tags differ from what their path implies",
+        "SELECT t.path, json_extract(t.tags, '$.album'), a.album, "
+        "json_extract(t.tags, '$.albumartist'), a.artist, json_extract(t.tags, '$.tracknumber'), t.tracknumber "
+        "FROM tracks t JOIN albums a ON a.dir = t.dir WHERE a.album IS NOT NULL AND ("
+        "COALESCE(json_extract(t.tags, '$.album'), '') != a.album "
+        "OR COALESCE(json_extract(t.tags, '$.albumartist'), '') != a.artist "
+        "OR COALESCE(json_extract(t.tags, '$.tracknumber'), '') != COALESCE(t.tracknumber, '')) "
+        "ORDER BY t.path",
+    ),
+    "untagged": (
+        "Tracks with no album or no artist tag",
+        "SELECT path FROM tracks WHERE COALESCE(json_extract(tags, '$.album'), '') = '' "
+        "OR COALESCE(json_extract(tags, '$.artist'), '') = '' ORDER BY path",
+    ),
+}
+
+
+def run_index_query(index_path: Path, name: str) -> int:
+    """Runs one of INDEX_QUERIES against an index built by earlier --index runs."""
+    if not index_path.exists():
+        print(f"Error: index not found: {index_path}")
+        return 1
+
+    title, sql = INDEX_QUERIES[name]
+    try:
+        conn = sqlite3.connect(index_path.resolve().as_uri() + "?mode=ro", uri=True)
+        try:
+            rows = conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as exc:
+        print(f"Error: cannot query index {index_path}: {exc}")
+        return 1
+
+    print(title)
+    print("=" * len(title))
+    if name == "summary":
+        albums, tracks = rows[0]
+        print(f"{albums} album(s), {tracks} track(s)")
+        return 0
+    for row in rows:
+        print("  " + " | ".join("" if value is None else str(value) for value in row))
+    print(f"\n{len(rows)} row(s)")
+    return 0
+
+
+# ----------------------------
+# Asyncio pipeline (--apply --async-io)
+# ----------------------------
+
+class MountLimiter:
+    """
+    Runs blocking filesystem calls on worker threads, at most `limit` at a
+    time per mount (st_dev). Each mount gets its own pool, so a slow SMB/NFS
+    share is kept busy without starving the others or the local disk.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self._pools: Dict[int, ThreadPoolExecutor] = {}
+
+    @property
+    def mounts(self) -> int:
+        return len(self._pools)
+
+    async def run(self, device: int, fn: Callable[..., R], *args: Any) -> R:
+        pool = self._pools.get(device)
+        if pool is None:
+            pool = self._pools[device] = ThreadPoolExecutor(max_workers=self.limit)
+        return await asyncio.get_running_loop().run_in_executor(pool, partial(fn, *args))
+
+    def close(self) -> None:
+        for pool in self._pools.values():
+            pool.shutdown()
+
+
+async def async_ordered_map(
+    fn: Callable[[T], Awaitable[R]],
+    items: Iterable[T],
+    window: int,
+) -> AsyncIterator[R]:
+    """ordered_map for coroutines: at most `window` tasks in flight, results in input order."""
+    pending: Deque["asyncio.Future[R]"] = deque()
+    try:
+        for item in items:
+            pending.append(asyncio.ensure_future(fn(item)))
+            if len(pending) >= window:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def async_scan_library(
+    root: Path,
+    limiter: MountLimiter,
+    previous: Optional[RunManifest] = None,
+    record: Optional[RunManifest] = None,
+    shard: Optional[Shard] = None,
+    prune: Optional[LayoutPrune] = None,
+) -> Tuple[List[ScanEntry], Dict[Path, int]]:
+    """
+    scan_library with every directory listed as its own task, so sibling
+    directories are listed concurrently. Also returns the st_dev of each
+    visited directory, which later phases use to pick a mount's limit.
+    """
+    entries: List[ScanEntry] = []
+    devices: Dict[Path, int] = {}
+
+    async def visit(rel_dir: Path, device: int) -> None:
+        result = await limiter.run(device, _visit_directory, root, rel_dir, previous, True, shard, prune)
+        if result is None:
+            return
+        devices[rel_dir] = result.device
+        if record is not None:
+            record.add(rel_dir.as_posix(), result.mtime_ns, result.subdirs)
+        entries.extend(result.entries)
+        await asyncio.gather(*(visit(rel_dir / name, result.device) for name in result.subdirs))
+
+    await visit(Path(), os.stat(root).st_dev)
+    entries.sort(key=lambda e: e.path.parts)
+    return entries, devices
+
+
+async def async_apply_renames(
+    root: Path,
+    actions: List[RenameAction],
+    limiter: MountLimiter,
+    devices: Dict[Path, int],
+    completed: List[RenameAction],
+    journal: Optional[ApplyJournal] = None,
+) -> int:
+    """
+    apply_rename_actions with the per-directory batches of each
+    schedule_renames level running concurrently.
+    """
+    if journal is not None:
+        actions = journal.pending_renames(actions)
+    root_device = devices.get(Path(), 0)
+    window = 2 * limiter.limit * max(1, limiter.mounts)
+
+    async def rename(batch: List[RenameAction]) -> List[Tuple[RenameAction, Optional[str]]]:
+        parent = batch[0].parent
+        if journal is not None:
+            journal.renaming(batch)
+        skipped = await limiter.run(devices.get(parent, root_device), rename_in_directory, root, parent, batch)
+        return list(zip(batch, skipped))
+
+    applied = 0
+    for level in schedule_renames(actions):
+        async for results in async_ordered_map(rename, level, window):
+            for action, skipped in results:
+                if report_rename(action, skipped):
+                    applied += 1
+                    completed.append(action)
+                    if journal is not None:
+                        journal.renamed(action)
+                elif journal is not None:
+                    journal.skipped(action)
+    return applied
+
+
+async def async_apply_metadata(
+    root: Path,
+    files: List[Path],
+    file_devices: List[int],
+    limiter: MountLimiter,
+    options: MetadataOptions,
+    journal: Optional[ApplyJournal] = None,
+) -> int:
+    """run_metadata(yes=True) with every tag read and save as a task."""
+    try:
+        cache = open_tag_cache(root, options)
+    except sqlite3.Error as exc:
+        print(f"Error: cannot open tag cache {options.index or options.tag_cache}: {exc}")
+        return 1
+
+    parsed = ParsedAudioCache(options.parsed_cache_size) if options.parsed_cache_size > 0 else None
+    device_of = dict(zip(files, file_devices))
+    if journal is not None:
+        files = list(journal.pending_files(files))
+    window = 2 * limiter.limit * max(1, limiter.mounts)
+
+    async def read(candidate: Tuple[Path, Dict[str, str]]) -> Optional[MetadataAction]:
+        rel_path, updates = candidate
+        current = await limiter.run(
+            device_of[rel_path],
+            read_tags_with_cache,
+            root / rel_path,
+            list(updates),
+            cache,
+            parsed,
+            options.header_only,
         )
+        return metadata_action(root, rel_path, updates, current, parsed)
 
-    return actions
+    def save(action: MetadataAction, defer_rewrites: bool) -> Optional[str]:
+        with STATS.measure("write tags"):
+            return write_metadata_action(root, action, parsed, options.tag_padding, defer_rewrites)
 
+    async def write(
+        action: MetadataAction, defer_rewrites: bool = options.defer_rewrites
+    ) -> Tuple[MetadataAction, Optional[str], Optional[StatSignature]]:
+        device = device_of[action.file_path]
+        outcome = await limiter.run(device, save, action, defer_rewrites)
+        signature = None
+        if outcome in (SAVE_IN_PLACE, SAVE_REWRITE) and cache is not None:
+            # Stat through the limiter so TagSaveRecorder does not block the loop.
+            signature = await limiter.run(device, stat_signature, root / action.file_path)
+        return action, outcome, signature
 
-def print_metadata_preview(actions: Iterable[MetadataAction]) -> None:
-    actions = list(actions)
-    if not actions:
-        print("No metadata updates required.")
-        return
+    planned = False
+    try:
+        try:
+            actions = [
+                action
+                async for action in async_ordered_map(read, metadata_candidates(root, files), window)
+                if action is not None
+            ]
+        except Exception as exc:  # noqa: BLE001
+            print(f"Error while reading media files: {exc}")
+            return 1
+        planned = True
 
-    print("Metadata update preview")
-    print("=" * 23)
-    for idx, action in enumerate(sorted(actions, key=lambda a: str(a.file_path)), start=1):
-        print(f"\n[{idx}] {action.file_path}")
-        print("    tag          current                      -> new")
-        print("    -------------------------------------------------------------")
-        for key in sorted(action.updates):
-            current = action.current.get(key, "")
-            new_val = action.updates[key]
-            print(f"    {key:<12} {current[:28]:<28} -> {new_val}")
+        print_metadata_preview(actions)
+        if not actions:
+            return 0
 
-    print(f"\nTotal files to update: {len(actions)}")
+        print("\nApplying metadata updates...")
+        recorder = TagSaveRecorder(
+            root, cache, journal, show_outcome=options.tag_padding is not None or options.defer_rewrites
+        )
+        try:
+            async for result in async_ordered_map(write, sorted(actions, key=lambda a: str(a.file_path)), window):
+                recorder.record(*result)
 
+            for idx, action in enumerate(recorder.take_deferred()):
+                if idx and options.rewrite_pause > 0:
+                    await asyncio.sleep(options.rewrite_pause)
+                recorder.record(*await write(action, defer_rewrites=False))
+        except Exception as exc:  # noqa: BLE001
+            print(f"Error while writing media files: {exc}")
+            return 1
 
-def apply_metadata_actions(root: Path, actions: Iterable[MetadataAction]) -> int:
-    applied = 0
+        print(f"\nDone. Updated {recorder.applied} file(s).")
+        return 0
+    finally:
+        if cache is not None:
+            cache.close(complete=planned)
 
-    for action in sorted(actions, key=lambda a: str(a.file_path)):
-        file_path = root / action.file_path
-        audio = mutagen_file(file_path)
-        if audio is None:
-            print(f"[SKIP] unsupported format: {action.file_path}")
+
+async def run_apply_async(
+    root: Path,
+    album_format: str,
+    track_format: str,
+    options: MetadataOptions,
+    limit: int,
+    previous: Optional[RunManifest] = None,
+    record: Optional[RunManifest] = None,
+    journal: Optional[ApplyJournal] = None,
+    shard: Optional[Shard] = None,
+    prune: Optional[LayoutPrune] = None,
+) -> int:
+    """
+    run_apply for high-latency (network) storage: directory listings, renames,
+    tag reads and tag saves are all issued as concurrent asyncio tasks, with
+    at most `limit` blocking calls in flight per mount. Planning (pattern
+    matching, tag derivation) is CPU-only and stays on the event loop.
+    Output matches a serial --apply run; --jobs, --write-jobs and --stream
+    do not apply.
+    """
+    if importlib.util.find_spec("mutagen") is None:
+        print("Error: missing dependency 'mutagen'. Install it with: pip install mutagen")
+        return 1
+
+    limiter = MountLimiter(limit)
+    try:
+        entries, devices = await async_scan_library(root, limiter, previous, record, shard, prune)
+
+        actions = gather_rename_actions(root, album_format, track_format, entries=entries)
+        print_rename_preview(actions)
+        completed: List[RenameAction] = []
+        if actions:
+            print("\nApplying changes...")
+            applied = await async_apply_renames(root, actions, limiter, devices, completed, journal)
+            print(f"\nDone. Applied {applied} rename(s).")
+
+        root_device = devices.get(Path(), 0)
+        originals = [e.path for e in entries if not e.is_dir]
+        files = predict_renamed_paths(originals, completed)
+        file_devices = [devices.get(path.parent, root_device) for path in originals]
+        return await async_apply_metadata(root, files, file_devices, limiter, options, journal)
+    finally:
+        limiter.close()
+
+
+# ----------------------------
+# Watch mode (Linux inotify)
+# ----------------------------
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE_SELF
+
+_INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class InotifyEvent(NamedTuple):
+    wd: int
+    mask: int
+    name: str
+
+
+class Inotify:
+    """
+    Minimal inotify handle. Uses the inotify_simple package when installed,
+    otherwise calls libc directly through ctypes.
+    """
+
+    def __init__(self) -> None:
+        self._simple: Any = None
+        self._libc: Any = None
+        if importlib.util.find_spec("inotify_simple") is not None:
+            from inotify_simple import INotify  # type: ignore
+
+            self._simple = INotify()
+            self.fd = self._simple.fileno()
+            return
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        if self._simple is not None:
+            return self._simple.add_watch(str(path), mask)
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_add_watch {path}: {os.strerror(err)}")
+        return wd
+
+    def read(self, timeout: Optional[float]) -> List[InotifyEvent]:
+        """Events available within `timeout` seconds (None blocks)."""
+        if self._simple is not None:
+            timeout_ms = None if timeout is None else int(timeout * 1000)
+            return [InotifyEvent(e.wd, e.mask, e.name) for e in self._simple.read(timeout=timeout_ms)]
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events: List[InotifyEvent] = []
+        pos = 0
+        while pos + _INOTIFY_EVENT.size <= len(data):
+            wd, mask, _cookie, length = _INOTIFY_EVENT.unpack_from(data, pos)
+            pos += _INOTIFY_EVENT.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b"\0"))
+            pos += length
+            events.append(InotifyEvent(wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        if self._simple is not None:
+            self._simple.close()
+        else:
+            os.close(self.fd)
+
+
+class LibraryWatcher:
+    """
+    Tracks inotify watches for every directory under root and turns events
+    into "dirty" album directories (the first two levels: Artist/Album),
+    each with the time of its latest event so bursts can be debounced.
+    """
+
+    def __init__(self, root: Path, inotify: Inotify) -> None:
+        self.root = root
+        self.inotify = inotify
+        self.watched: Dict[int, Path] = {}  # wd -> root-relative directory
+        self.dirty: Dict[Path, float] = {}  # album -> monotonic time of last event
+        self.fingerprints: Dict[Path, int] = {}  # album -> state right after we processed it
+
+    def add_tree(self, rel_dir: Path, mark: bool = False) -> None:
+        """Watches rel_dir and everything below it; `mark` flags the albums found."""
+        self._add_watch(rel_dir)
+        if mark:
+            self._mark(rel_dir)
+        for entry in iter_library(self.root, start=rel_dir):
+            if entry.is_dir and not (self.root / entry.path).is_symlink():
+                self._add_watch(entry.path)
+                if mark:
+                    self._mark(entry.path)
+
+    def _add_watch(self, rel_dir: Path) -> None:
+        try:
+            wd = self.inotify.add_watch(self.root / rel_dir, WATCH_MASK)
+        except OSError as exc:
+            if exc.errno == errno.ENOSPC:
+                raise OSError(exc.errno, "inotify watch limit reached; raise fs.inotify.max_user_watches") from exc
+            if exc.errno in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise
+        # A renamed directory keeps its wd, so this also refreshes moved paths.
+        self.watched[wd] = rel_dir
+
+    def _mark(self, rel_path: Path) -> None:
+        if len(rel_path.parts) >= 2:
+            self.dirty[Path(*rel_path.parts[:2])] = time.monotonic()
+
+    def handle(self, event: InotifyEvent) -> None:
+        if event.mask & IN_Q_OVERFLOW:
+            print("[WARN] inotify queue overflowed; rescanning the whole library")
+            self.add_tree(Path(), mark=True)
+            return
+        if event.mask & (IN_IGNORED | IN_DELETE_SELF):
+            self.watched.pop(event.wd, None)
+            return
+
+        rel_dir = self.watched.get(event.wd)
+        if rel_dir is None:
+            return
+
+        rel_path = rel_dir / event.name if event.name else rel_dir
+        if event.mask & IN_ISDIR and event.mask & (IN_CREATE | IN_MOVED_TO):
+            # Directories moved in arrive complete, with no events for their contents.
+            self.add_tree(rel_path, mark=True)
+        else:
+            self._mark(rel_path)
+
+    def next_timeout(self, settle: float) -> Optional[float]:
+        if not self.dirty:
+            return None
+        oldest = min(self.dirty.values())
+        return max(0.0, oldest + settle - time.monotonic())
+
+    def pop_settled(self, settle: float) -> List[Path]:
+        now = time.monotonic()
+        settled = sorted(album for album, last in self.dirty.items() if now - last >= settle)
+        for album in settled:
+            del self.dirty[album]
+        return settled
+
+
+def album_fingerprint(root: Path, album: Path) -> Optional[int]:
+    """Hash of every path, size and mtime under an album; None if it is gone."""
+    if not (root / album).is_dir():
+        return None
+    state = []
+    for entry in iter_library(root, start=album):
+        try:
+            st = (root / entry.path).stat()
+        except OSError:
             continue
+        state.append((entry.path.as_posix(), entry.is_dir, st.st_size, st.st_mtime_ns))
+    return hash(tuple(sorted(state)))
 
-        for key, value in action.updates.items():
-            audio[key] = [value]
 
-        audio.save()
-        applied += 1
-        print(f"[OK] updated tags: {action.file_path}")
+def process_album(
+    root: Path,
+    album: Path,
+    album_format: str,
+    track_format: str,
+    options: MetadataOptions,
+    watcher: LibraryWatcher,
+) -> int:
+    """Runs the rename + metadata pipeline on a single settled album directory."""
+    fingerprint = album_fingerprint(root, album)
+    if fingerprint is None or watcher.fingerprints.pop(album, None) == fingerprint:
+        # Gone, or the only events were our own renames/saves from last time.
+        return 0
 
-    return applied
+    print(f"\n=== {album} ===")
+    entries = [ScanEntry(path=album, is_dir=True), *iter_library(root, start=album)]
+    completed: List[RenameAction] = []
+    rc = run_apply(root, album_format, track_format, entries, options, completed=completed)
 
+    new_name = next((a.target.name for a in completed if a.kind == "dir" and a.source == album), album.name)
+    processed = album.with_name(new_name)
+    after = album_fingerprint(root, processed)
+    if after is not None:
+        watcher.fingerprints[processed] = after
+    return rc
 
-def run_metadata(root: Path, yes: bool) -> int:
-    if importlib.util.find_spec("mutagen") is None:
-        print("Error: missing dependency 'mutagen'. Install it with: pip install mutagen")
-        return 1
 
+def run_watch(
+    root: Path,
+    album_format: str,
+    track_format: str,
+    options: MetadataOptions,
+    settle: float,
+) -> int:
+    """
+    Watches root and runs the --apply pipeline on each album directory once it
+    has seen no events for `settle` seconds. Existing albums are left alone
+    until something changes in them (use --apply for a full pass).
+    """
     try:
-        actions = gather_metadata_actions(root)
-    except Exception as exc:  # noqa: BLE001
-        print(f"Error while reading media files: {exc}")
+        inotify = Inotify()
+    except (OSError, AttributeError) as exc:
+        print(f"Error: inotify is not available: {exc}")
         return 1
 
-    print_metadata_preview(actions)
-    if not actions:
+    try:
+        watcher = LibraryWatcher(root, inotify)
+        try:
+            watcher.add_tree(Path())
+        except OSError as exc:
+            print(f"Error: cannot watch {root}: {exc}")
+            return 1
+
+        print(f"Watching {root} ({len(watcher.watched)} directories, settle {settle:g}s). Press Ctrl+C to stop.")
+        while True:
+            for event in inotify.read(watcher.next_timeout(settle)):
+                watcher.handle(event)
+            for album in watcher.pop_settled(settle):
+                process_album(root, album, album_format, track_format, options, watcher)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
         return 0
+    finally:
+        inotify.close()
 
-    if not yes:
-        answer = input("\nApply these metadata changes? [y/N]: ").strip().lower()
-        if answer not in {"y", "yes"}:
-            print("Aborted. No changes applied.")
-            return 0
 
-    print("\nApplying metadata updates...")
+# ----------------------------
+# Benchmark (synthetic library)
+# ----------------------------
+
+def _mp4_atom(name: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), name) + payload
+
+
+def synthetic_flac() -> bytes:
+    """fLaC marker + a single STREAMINFO block (44.1 kHz, stereo, 16-bit, no frames)."""
+    info = struct.pack(">HH", 4096, 4096) + b"\x00" * 6
+    info += ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, "big") + b"\x00" * 16
+    return b"fLaC" + bytes([0x80]) + len(info).to_bytes(3, "big") + info
+
+
+def synthetic_mp3() -> bytes:
+    """A few silent MPEG-1 Layer III frames (128 kbps, 44.1 kHz)."""
+    return (b"\xff\xfb\x90\x64" + b"\x00" * 413) * 4
+
+
+def synthetic_m4a() -> bytes:
+    """ftyp + moov with one sound track (mvhd, mdhd, hdlr) + an empty mdat."""
+    ftyp = _mp4_atom(b"ftyp", b"M4A \x00\x00\x00\x00M4A mp42isom")
+    mvhd = _mp4_atom(b"mvhd", b"\x00" * 12 + struct.pack(">II", 1000, 1000) + b"\x00" * 80)
+    mdhd = _mp4_atom(b"mdhd", b"\x00" * 12 + struct.pack(">II", 44100, 44100) + b"\x00" * 4)
+    hdlr = _mp4_atom(b"hdlr", b"\x00" * 8 + b"soun" + b"\x00" * 13)
+    trak = _mp4_atom(b"trak", _mp4_atom(b"mdia", mdhd + hdlr))
+    return ftyp + _mp4_atom(b"moov", mvhd + trak) + _mp4_atom(b"mdat", b"\x00" * 64)
+
+
+SYNTHETIC_AUDIO: Dict[str, Callable[[], bytes]] = {
+    ".flac": synthetic_flac,
+    ".mp3": synthetic_mp3,
+    ".m4a": synthetic_m4a,
+}
+
+
+def generate_synthetic_library(
+    root: Path,
+    tracks: int,
+    tracks_per_album: int = 10,
+    albums_per_artist: int = 5,
+) -> Dict[str, int]:
+    """
+    Writes `tracks` files laid out as Artist/YYYY - Album/N - Title.ext (the
+    pre-rename input format), cycling through SYNTHETIC_AUDIO formats.
+    Returns the number of files written per extension.
+    """
+    payloads = {ext: make() for ext, make in SYNTHETIC_AUDIO.items()}
+    extensions = list(payloads)
+    counts = {ext: 0 for ext in extensions}
+
+    for idx in range(tracks):
+        album_no, track_no = divmod(idx, tracks_per_album)
+        artist_no = album_no // albums_per_artist
+        album_dir = root / f"Artist {artist_no:05d}" / f"{1970 + album_no % 50} - Album {album_no:06d}"
+        if track_no == 0:
+            album_dir.mkdir(parents=True, exist_ok=True)
+
+        ext = extensions[idx % len(extensions)]
+        (album_dir / f"{track_no + 1} - Title {track_no + 1}{ext}").write_bytes(payloads[ext])
+        counts[ext] += 1
+    return counts
+
+
+def peak_rss_bytes() -> Optional[int]:
     try:
-        applied = apply_metadata_actions(root, actions)
-    except Exception as exc:  # noqa: BLE001
-        print(f"Error while writing media files: {exc}")
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_benchmark(
+    tracks: int,
+    album_format: str,
+    track_format: str,
+    options: MetadataOptions,
+    work_dir: Optional[Path] = None,
+) -> int:
+    """
+    Generates a synthetic library in a temporary directory and times each
+    phase separately, reporting files/sec and peak RSS after each phase.
+    Per-file [OK] output is discarded so it does not distort the timings.
+    """
+    if importlib.util.find_spec("mutagen") is None:
+        print("Error: missing dependency 'mutagen'. Install it with: pip install mutagen")
         return 1
 
-    print(f"\nDone. Updated {applied} file(s).")
+    root = Path(tempfile.mkdtemp(prefix="prep_files_bench_", dir=work_dir))
+    rows: List[Tuple[str, int, float, Optional[int]]] = []
+
+    def timed(phase: str, fn: Callable[[], Any], count: Callable[[Any], int]) -> Any:
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            result = fn()
+        rows.append((phase, count(result), time.perf_counter() - start, peak_rss_bytes()))
+        return result
+
+    try:
+        counts = timed("generate library", lambda: generate_synthetic_library(root, tracks), lambda c: sum(c.values()))
+        print(f"Benchmark: {tracks} track(s) ({', '.join(f'{n} {ext}' for ext, n in counts.items())}) in {root}")
+
+        renames = timed(
+            "gather_rename_actions",
+            lambda: gather_rename_actions(root, album_format, track_format, walk_jobs=options.walk_jobs),
+            lambda _: tracks,
+        )
+        timed("apply_rename_actions", lambda: apply_rename_actions(root, renames), lambda applied: applied)
+        actions = timed(
+            "gather_metadata_actions",
+            lambda: gather_metadata_actions(
+                root, jobs=options.jobs, header_only=options.header_only, walk_jobs=options.walk_jobs
+            ),
+            lambda _: tracks,
+        )
+        timed(
+            "apply_metadata_actions",
+            lambda: apply_metadata_actions(root, actions, write_jobs=options.write_jobs),
+            lambda applied: applied,
+        )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    print(f"\n{'phase':<26} {'files':>9} {'seconds':>9} {'files/s':>11} {'peak RSS':>10}")
+    print("-" * 69)
+    for phase, files, seconds, rss in rows:
+        rate = files / seconds if seconds > 0 else float("inf")
+        rss_text = f"{rss / (1 << 20):.1f} MiB" if rss is not None else "n/a"
+        print(f"{phase:<26} {files:>9} {seconds:>9.3f} {rate:>11.1f} {rss_text:>10}")
     return 0
 
 
+# ----------------------------
+# Profiling (--profile cpu / mem)
+# ----------------------------
+
+PROFILE_TOP = 25  # functions/lines listed in each profile summary
+PROFILE_PRINT_TOP = 10  # of those, shown on stdout
+
+
+def run_profiled(kind: str, out_base: Path, fn: Callable[[], int]) -> int:
+    """
+    Runs fn under cProfile ("cpu") or tracemalloc ("mem") and writes:
+      cpu: <out_base>.prof (pstats/snakeviz) and <out_base>.txt, the functions
+           with the most own time and most cumulative time;
+      mem: <out_base>.tracemalloc (Snapshot.load) and <out_base>.txt, the
+           source lines holding the most memory at the end plus the peak.
+    cProfile only sees the main thread, so tag reads on --jobs threads and
+    writes on --write-jobs processes show up as waits on their pool.
+    """
+    import cProfile
+    import io
+    import pstats
+    import tracemalloc
+
+    out_base.parent.mkdir(parents=True, exist_ok=True)
+    summary_path = out_base.with_name(out_base.name + ".txt")
+
+    if kind == "cpu":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            rc = fn()
+        finally:
+            profiler.disable()
+            data_path = out_base.with_name(out_base.name + ".prof")
+            profiler.dump_stats(str(data_path))
+            text = io.StringIO()
+            stats = pstats.Stats(profiler, stream=text).strip_dirs()
+            for order in ("tottime", "cumulative"):
+                text.write(f"=== top {PROFILE_TOP} by {order} ===\n")
+                stats.sort_stats(order).print_stats(PROFILE_TOP)
+            summary_path.write_text(text.getvalue(), encoding="utf-8")
+
+            print("\nHottest functions (own time)")
+            print("=" * 28)
+            hottest = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+            for (filename, line, func), (_, calls, tottime, cumtime, _) in hottest[:PROFILE_PRINT_TOP]:
+                print(f"  {tottime:>8.3f}s own {cumtime:>8.3f}s cum {calls:>9} calls  {func} ({filename}:{line})")
+        print(f"CPU profile: {data_path}, summary: {summary_path}")
+        return rc
+
+    tracemalloc.start(10)
+    try:
+        rc = fn()
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        data_path = out_base.with_name(out_base.name + ".tracemalloc")
+        snapshot.dump(str(data_path))
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        top = snapshot.statistics("lineno")[:PROFILE_TOP]
+        lines = [f"peak traced memory: {peak / (1 << 20):.1f} MiB", f"=== top {PROFILE_TOP} lines by size ==="]
+        lines += [str(stat) for stat in top]
+        summary_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+        print("\nLargest allocations (live at exit)")
+        print("=" * 34)
+        print(f"  peak traced memory: {peak / (1 << 20):.1f} MiB")
+        for stat in top[:PROFILE_PRINT_TOP]:
+            frame = stat.traceback[0]
+            print(f"  {stat.size / 1024:>10.1f} KiB {stat.count:>8} blocks  {frame.filename}:{frame.lineno}")
+    print(f"Memory profile: {data_path}, summary: {summary_path}")
+    return rc
+
+
 # ----------------------------
 # CLI / Dispatch
 # ----------------------------
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1, got {value}")
+    return number
+
+
+def non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be >= 0, got {value}")
+    return number
+
+
+def shard_spec(value: str) -> Shard:
+    number, sep, total = value.partition("/")
+    try:
+        shard = Shard(int(number), int(total))
+    except ValueError:
+        shard = None
+    if not sep or shard is None or not 1 <= shard.number <= shard.total:
+        raise argparse.ArgumentTypeError(f"expected K/N with 1 <= K <= N, got {value}")
+    return shard
+
+
 def build_parser() -> argparse.ArgumentParser:
     examples = r"""
 Examples:
@@ -434,6 +3639,35 @@ Examples:
     mode.add_argument("--apply", action="store_true", help="Run filenames then metadata with no confirmations.")
     mode.add_argument("--filenames", action="store_true", help="Run filename/folder normalization only.")
     mode.add_argument("--metadata", action="store_true", help="Run metadata tagging only.")
+    mode.add_argument(
+        "--watch",
+        action="store_true",
+        help="Stay running and apply renames + metadata to each album directory as new files settle (Linux).",
+    )
+    mode.add_argument(
+        "--rollback",
+        action="store_true",
+        help="Undo the renames recorded in --journal (newest first), e.g. after an interrupted run.",
+    )
+    mode.add_argument(
+        "--merge",
+        type=Path,
+        nargs="+",
+        metavar="FILE",
+        help="Merge the --stats-json reports or --plan-out plans of a sharded run into --merge-out.",
+    )
+    mode.add_argument(
+        "--index-query",
+        choices=sorted(INDEX_QUERIES),
+        default=None,
+        help="Answer a question from --index without scanning the library, e.g. inconsistent-albumartist.",
+    )
+    mode.add_argument(
+        "--benchmark",
+        type=positive_int,
+        metavar="TRACKS",
+        help="Time every phase on a generated library of TRACKS FLAC/MP3/M4A files in a temporary directory.",
+    )
 
     parser.add_argument(
         "--root",
@@ -461,14 +3695,254 @@ Examples:
         help="Apply changes without interactive confirmation (for --filenames / --metadata modes).",
     )
 
+    # Metadata options
+    parser.add_argument(
+        "--tag-cache",
+        type=Path,
+        default=None,
+        help="SQLite file caching tags per file; files with unchanged size/mtime/inode are not reopened.",
+    )
+    parser.add_argument(
+        "--index",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help=(
+            "SQLite library index of albums, tracks, derived and current tags. Used as the tag cache by "
+            "--metadata/--apply and kept in sync with what they see; query it with --index-query."
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=1,
+        help="Number of threads reading tags while planning metadata updates (default: 1).",
+    )
+    parser.add_argument(
+        "--walk-jobs",
+        type=positive_int,
+        default=1,
+        help=(
+            "Number of threads listing directories while walking the library (default: 1); "
+            "raise it on NFS/SMB, where each listing waits on a server round trip."
+        ),
+    )
+    parser.add_argument(
+        "--write-jobs",
+        type=positive_int,
+        default=1,
+        help="Number of worker processes saving tags when applying metadata updates (default: 1).",
+    )
+    parser.add_argument(
+        "--parsed-cache",
+        type=non_negative_int,
+        default=256,
+        help=(
+            "For non-interactive runs, keep up to N files parsed during planning and save them "
+            "without re-parsing (default: 256, 0 disables; unused with --write-jobs > 1)."
+        ),
+    )
+    parser.add_argument(
+        "--async-io",
+        type=positive_int,
+        default=None,
+        metavar="N",
+        help=(
+            "With --apply, run listings, renames, tag reads and saves as concurrent asyncio tasks, "
+            "at most N at a time per mount (for SMB/NFS libraries; replaces --jobs/--walk-jobs/--write-jobs)."
+        ),
+    )
+    parser.add_argument(
+        "--header-only-tags",
+        action="store_true",
+        help="Read tags straight from the tag block (FLAC, Ogg, MP4, ID3) without a full mutagen parse.",
+    )
+    parser.add_argument(
+        "--tag-padding",
+        type=non_negative_int,
+        default=None,
+        metavar="BYTES",
+        help=(
+            "Keep existing tag padding so saves that fit are done in place, and reserve BYTES of padding "
+            "when a tag outgrows it (a full file rewrite). Reports each save as in place or rewrite."
+        ),
+    )
+    parser.add_argument(
+        "--defer-rewrites",
+        action="store_true",
+        help=(
+            "Save tags that fit their padding first and leave saves that would rewrite the whole file "
+            "to a serial phase afterwards (per batch with --stream)."
+        ),
+    )
+    parser.add_argument(
+        "--rewrite-pause",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="With --defer-rewrites, wait this long between deferred rewrites (default: 0).",
+    )
+
+    # Shared output options
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=(
+            "Print the preview while scanning (sorted per directory) instead of after planning the whole "
+            "tree; without a prompt, changes are applied as they are found."
+        ),
+    )
+    parser.add_argument(
+        "--benchmark-dir",
+        type=Path,
+        default=None,
+        help="With --benchmark, create the temporary library under this directory (default: system temp).",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=10.0,
+        metavar="SECONDS",
+        help="With --watch, wait until an album has had no file events for this long (default: 10).",
+    )
+    parser.add_argument(
+        "--incremental",
+        type=Path,
+        default=None,
+        metavar="MANIFEST",
+        help=(
+            "Only look at directories whose mtime changed since the run that wrote MANIFEST (JSON). "
+            "The manifest is updated after each successful non-interactive run."
+        ),
+    )
+    parser.add_argument(
+        "--plan-out",
+        type=Path,
+        default=None,
+        metavar="PLAN",
+        help=(
+            "With --filenames or --metadata, write the planned changes to PLAN (JSON lines; .gz/.zst "
+            "compressed) instead of applying them."
+        ),
+    )
+    parser.add_argument(
+        "--plan-in",
+        type=Path,
+        default=None,
+        metavar="PLAN",
+        help=(
+            "With --filenames or --metadata, apply a plan written by --plan-out without rescanning; "
+            "files changed since planning are skipped."
+        ),
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help=(
+            "Record every applied rename and tag save in PATH (fsync'ed in batches) so an interrupted "
+            "run can be continued with --resume or undone with --rollback."
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="With --journal, skip the renames and tag saves it already records and continue.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_spec,
+        default=None,
+        metavar="K/N",
+        help=(
+            "Only process slice K of N of the artist directories (stable hash of the name), so N hosts "
+            "can each run a disjoint part of a shared library."
+        ),
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help=(
+            "Only walk the Artist/Album/track layout (--root must be the library root): skip hidden "
+            "directories, album-level directories whose name is not an album, and anything inside albums."
+        ),
+    )
+    parser.add_argument(
+        "--ignore",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help='With --prune, also skip directories whose name matches GLOB (repeatable), e.g. "scans" or "*artwork*".',
+    )
+    parser.add_argument(
+        "--merge-out",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help="Output file for --merge.",
+    )
+
+    # Instrumentation
+    parser.add_argument(
+        "--profile",
+        choices=("cpu", "mem"),
+        default=None,
+        help=(
+            "Profile the --filenames/--metadata/--apply run with cProfile (cpu) or tracemalloc (mem) "
+            "and print the hottest functions / largest allocations."
+        ),
+    )
+    parser.add_argument(
+        "--profile-out",
+        type=Path,
+        default=Path("prep_files-profile"),
+        metavar="BASE",
+        help="File name prefix for --profile output: BASE.prof or BASE.tracemalloc, plus BASE.txt (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print per-phase time, item counts, bytes read/written and skip reasons when the run ends.",
+    )
+    parser.add_argument(
+        "--stats-json",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help="Write the same run statistics to PATH as JSON.",
+    )
+
     return parser
 
 
+def metadata_options_from_args(args: argparse.Namespace) -> MetadataOptions:
+    return MetadataOptions(
+        tag_cache=args.tag_cache,
+        jobs=args.jobs,
+        walk_jobs=args.walk_jobs,
+        write_jobs=args.write_jobs,
+        parsed_cache_size=args.parsed_cache,
+        header_only=args.header_only_tags,
+        stream=args.stream,
+        plan_in=args.plan_in,
+        plan_out=args.plan_out,
+        index=args.index,
+        index_full_scan=not (args.shard or args.prune or args.incremental or args.plan_in or args.watch or args.resume),
+        tag_padding=args.tag_padding,
+        defer_rewrites=args.defer_rewrites,
+        rewrite_pause=args.rewrite_pause,
+    )
+
+
+def layout_prune_from_args(args: argparse.Namespace) -> Optional[LayoutPrune]:
+    return LayoutPrune(tuple(args.ignore)) if args.prune else None
+
+
 def main() -> int:
     parser = build_parser()
 
     # If no args were provided, show help + exit 0
-    import sys
     if len(sys.argv) == 1:
         parser.print_help()
         return 0
@@ -480,25 +3954,221 @@ def main() -> int:
         print(f"Error: root is not a directory: {root}")
         return 1
 
+    if args.profile and (args.watch or args.benchmark):
+        parser.error("--profile works with --filenames, --metadata or --apply")
+    if args.async_io and not args.apply:
+        parser.error("--async-io works with --apply")
+    if args.rewrite_pause and not args.defer_rewrites:
+        parser.error("--rewrite-pause works with --defer-rewrites")
+    if (args.plan_in or args.plan_out) and not (args.filenames or args.metadata):
+        parser.error("--plan-in/--plan-out work with --filenames or --metadata")
+    if args.plan_in and args.plan_out:
+        parser.error("--plan-in and --plan-out cannot be combined")
+    if args.shard and (args.plan_in or not (args.filenames or args.metadata or args.apply)):
+        parser.error("--shard works with --filenames, --metadata or --apply (and not --plan-in)")
+    if args.prune and (args.plan_in or not (args.filenames or args.metadata or args.apply)):
+        parser.error("--prune works with --filenames, --metadata or --apply (and not --plan-in)")
+    if args.ignore and not args.prune:
+        parser.error("--ignore works with --prune")
+    if args.index and args.tag_cache:
+        parser.error("--index already caches tags; drop --tag-cache")
+    if args.index_query and args.index is None:
+        parser.error("--index-query needs --index")
+    if args.merge and args.merge_out is None:
+        parser.error("--merge needs --merge-out")
+    if (args.resume or args.rollback) and args.journal is None:
+        parser.error("--resume/--rollback need --journal")
+    if args.journal is not None and (args.watch or args.benchmark):
+        parser.error("--journal works with --filenames, --metadata, --apply or --rollback")
+
+    mode = (
+        "index-query" if args.index_query
+        else "merge" if args.merge
+        else "benchmark" if args.benchmark
+        else "rollback" if args.rollback
+        else "watch" if args.watch
+        else "apply" if args.apply
+        else "filenames" if args.filenames
+        else "metadata"
+    )
+    prune = layout_prune_from_args(args)
+    previous: Optional[RunManifest] = None
+    record: Optional[RunManifest] = None
+    if args.incremental is not None and mode in ("apply", "filenames", "metadata") and args.plan_in is None:
+        # Each shard (and pruning setup) walks a different slice, so each needs its own manifest state.
+        manifest_mode = f"{mode} shard {args.shard}" if args.shard else mode
+        if prune is not None:
+            manifest_mode = f"{manifest_mode} {prune}"
+        previous = RunManifest.load(args.incremental, root, manifest_mode)
+        record = RunManifest(root, manifest_mode)
+
+    journal: Optional[ApplyJournal] = None
+    if args.journal is not None and not args.rollback and args.plan_out is None:
+        try:
+            journal = ApplyJournal(args.journal, root, resume=args.resume)
+        except (OSError, ValueError) as exc:
+            print(f"Error: cannot open journal {args.journal}: {exc}")
+            return 1
+
+    if args.stats or args.stats_json is not None:
+        STATS.enable()
+    rc = 1
+    try:
+        if args.profile:
+            rc = run_profiled(
+                args.profile,
+                args.profile_out,
+                partial(run_mode, parser, args, root, previous, record, journal),
+            )
+        else:
+            rc = run_mode(parser, args, root, previous, record, journal)
+    finally:
+        if journal is not None:
+            journal.close(complete=rc == 0)
+        if STATS.enabled:
+            extra = {"mode": mode, "root": str(root)}
+            if args.shard:
+                extra["shard"] = str(args.shard)
+            report = STATS.report(**extra)
+            if args.stats:
+                print_stats_summary(report)
+            if args.stats_json is not None:
+                try:
+                    args.stats_json.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+                except OSError as exc:
+                    print(f"Error: cannot write stats {args.stats_json}: {exc}")
+
+    # Interactive runs may have been declined, so only unattended runs advance
+    # the manifest past the changes they saw.
+    if rc == 0 and record is not None and (args.apply or args.yes) and args.plan_out is None:
+        try:
+            record.save(args.incremental)
+        except OSError as exc:
+            print(f"Error: cannot write manifest {args.incremental}: {exc}")
+            return 1
+    return rc
+
+
+def run_mode(
+    parser: argparse.ArgumentParser,
+    args: argparse.Namespace,
+    root: Path,
+    previous: Optional[RunManifest],
+    record: Optional[RunManifest],
+    journal: Optional[ApplyJournal] = None,
+) -> int:
+    prune = layout_prune_from_args(args)
+    if args.benchmark:
+        return run_benchmark(
+            args.benchmark,
+            args.album_format,
+            args.track_format,
+            metadata_options_from_args(args),
+            work_dir=args.benchmark_dir,
+        )
+
+    if args.index_query:
+        return run_index_query(args.index, args.index_query)
+
+    if args.merge:
+        return run_merge(args.merge, args.merge_out)
+
+    if args.rollback:
+        return run_rollback(root, args.journal)
+
+    # --watch: long-running, processes albums as they settle
+    if args.watch:
+        return run_watch(root, args.album_format, args.track_format, metadata_options_from_args(args), args.settle)
+
     # --apply: always non-interactive, regardless of --yes
+    if args.apply and args.async_io:
+        return asyncio.run(
+            run_apply_async(
+                root,
+                args.album_format,
+                args.track_format,
+                metadata_options_from_args(args),
+                args.async_io,
+                previous,
+                record,
+                journal,
+                args.shard,
+                prune,
+            )
+        )
     if args.apply:
-        rc = run_filenames(root, args.album_format, args.track_format, yes=True)
-        if rc != 0:
-            return rc
-        return run_metadata(root, yes=True)
+        entries = scan_library(root, previous, record, args.shard, args.walk_jobs, prune)
+        return run_apply(
+            root,
+            args.album_format,
+            args.track_format,
+            entries,
+            metadata_options_from_args(args),
+            journal=journal,
+        )
 
     # rename-only
     if args.filenames:
-        return run_filenames(root, args.album_format, args.track_format, yes=args.yes)
+        return run_filenames(
+            root,
+            args.album_format,
+            args.track_format,
+            yes=args.yes,
+            entries=(
+                iter_library(root, previous, record, shard=args.shard, walk_jobs=args.walk_jobs, prune=prune)
+                if args.plan_in is None
+                else None
+            ),
+            stream=args.stream,
+            plan_in=args.plan_in,
+            plan_out=args.plan_out,
+            journal=journal,
+        )
 
     # metadata-only
     if args.metadata:
-        return run_metadata(root, yes=args.yes)
+        files = None
+        if args.plan_in is None:
+            walk = iter_library(root, previous, record, shard=args.shard, walk_jobs=args.walk_jobs, prune=prune)
+            files = (entry.path for entry in walk if not entry.is_dir)
+        return run_metadata(root, yes=args.yes, files=files, options=metadata_options_from_args(args), journal=journal)
 
     # If somehow no mode selected (shouldn't happen due to early help), show help
     parser.print_help()
     return 0
 
 
+def run_apply(
+    root: Path,
+    album_format: str,
+    track_format: str,
+    entries: List[ScanEntry],
+    options: MetadataOptions,
+    completed: Optional[List[RenameAction]] = None,
+    journal: Optional[ApplyJournal] = None,
+) -> int:
+    """
+    Renames then tags, with no prompts. One walk (`entries`) feeds both
+    phases; the metadata phase sees the tree through the renames that were
+    actually applied instead of rescanning it.
+    """
+    if completed is None:
+        completed = []
+    rc = run_filenames(
+        root,
+        album_format,
+        track_format,
+        yes=True,
+        entries=entries,
+        completed=completed,
+        stream=options.stream,
+        journal=journal,
+    )
+    if rc != 0:
+        return rc
+    files = predict_renamed_paths((e.path for e in entries if not e.is_dir), completed)
+    return run_metadata(root, yes=True, files=files, options=options, journal=journal)
+
+
 if __name__ == "__main__":
     raise SystemExit(main())